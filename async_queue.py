@@ -0,0 +1,45 @@
+from rq import Queue
+from typing import Dict
+from rq.job import Job, JobStatus
+from rq.utils import now
+
+
+# Buffers the commands Queue.enqueue_job sends for a job without dependencies on any pipeline,
+# including a redis.asyncio one, so many jobs can be enqueued in a single round trip.
+# Job serialization is still done by RQ itself.
+def push_job(pipe, queue: Queue, job: Job):
+    pipe.sadd(queue.redis_queues_keys, queue.key)
+
+    job.origin = queue.name
+    job.enqueued_at = now()
+    if job.timeout is None:
+        job.timeout = queue._default_timeout
+
+    job.set_status(JobStatus.QUEUED, pipeline=pipe)
+    job.save(pipeline=pipe)
+    job.cleanup(ttl=job.ttl, pipeline=pipe)
+    queue.push_job_id(job.id, pipeline=pipe)
+
+
+# Length of every queue registered in rq:queues in one round trip, flat [key, length, key, length, ...]
+QUEUE_DEPTHS_SCRIPT = """
+local depths = {}
+for _, key in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    depths[#depths + 1] = key
+    depths[#depths + 1] = redis.call('LLEN', key)
+end
+return depths
+"""
+
+
+def queue_depths_args() -> list:
+    return [QUEUE_DEPTHS_SCRIPT, 1, Queue.redis_queues_keys]
+
+
+# Queue name -> number of queued jobs
+def parse_queue_depths(reply: list) -> Dict[str, int]:
+    depths = {}
+    for key, depth in zip(reply[::2], reply[1::2]):
+        key = key.decode() if isinstance(key, bytes) else key
+        depths[key[len(Queue.redis_queue_namespace_prefix):]] = int(depth)
+    return depths
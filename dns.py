@@ -1,25 +1,128 @@
-import os 
-import time 
-import socket 
+import os
+import socket
+import threading
+
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional
+
+# Docker DNS does not hand out useful TTLs, answers are trusted for DNS_TTL seconds and refreshed in the
+# background before that, so lookups never wait on DNS once a host is known
+DNS_TTL = float(os.getenv("DNS_TTL", "5"))
+# A failed lookup is not retried for this long, callers fail fast instead of hammering the resolver
+DNS_NEGATIVE_TTL = float(os.getenv("DNS_NEGATIVE_TTL", "2"))
+# Hosts nobody asked for in this long are no longer refreshed
+_IDLE_SECONDS = 300
+
+
+class _Entry:
+    def __init__(self):
+        self.addresses: List[str] = []
+        self.error: Optional[Exception] = None
+        self.expires = 0.0
+        self.last_used = monotonic()
+
+
+class Resolver:
+    def __init__(self, ttl: float = DNS_TTL, negative_ttl: float = DNS_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: Dict[str, _Entry] = {}
+        self._listeners: List[Callable[[str, List[str], List[str]], None]] = []
+        self._lock = threading.Lock()
+        self._refresher = None
+        os.register_at_fork(after_in_child=self.__after_fork)
+
+    # Called with (host, old addresses, new addresses) whenever the address set of a host changes
+    def on_change(self, listener: Callable[[str, List[str], List[str]], None]):
+        self._listeners.append(listener)
+
+    def resolve_all(self, host: str) -> List[str]:
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is None:
+                entry = self._entries[host] = _Entry()
+            entry.last_used = monotonic()
+            fresh = monotonic() < entry.expires
+
+        if not fresh:
+            # Only the first lookup of a host, or one that stopped being refreshed, waits on DNS
+            self.__refresh(host, entry)
+        self.__start_refresher()
+
+        if entry.addresses:
+            return list(entry.addresses)
+        raise entry.error
+
+    def __lookup(self, host: str) -> List[str]:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+        return sorted({info[4][0] for info in infos})
+
+    def __refresh(self, host: str, entry: _Entry):
+        try:
+            addresses = self.__lookup(host)
+            if not addresses:
+                raise socket.gaierror(f"No addresses for {host}")
+        except OSError as e:
+            # The last known addresses keep being served, a resolver hiccup is no reason to drop them
+            with self._lock:
+                failing = entry.error is not None
+                entry.error = e
+                entry.expires = monotonic() + self.negative_ttl
+            if not failing:
+                print(f"[DNS] Lookup of {host} failed:", e, flush=True)
+            return
+
+        with self._lock:
+            old = entry.addresses
+            entry.addresses = addresses
+            entry.error = None
+            entry.expires = monotonic() + self.ttl
+
+        if old and old != addresses:
+            print(f"[DNS] {host} changed from {old} to {addresses}", flush=True)
+            for listener in self._listeners:
+                listener(host, old, addresses)
+
+    def __start_refresher(self):
+        if self._refresher is not None:
+            return
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self.__refresh_loop, name="dns-refresh", daemon=True)
+                self._refresher.start()
+
+    # Refreshes every host in use shortly before its answer expires
+    def __refresh_loop(self):
+        while True:
+            sleep(max(0.5, min(self.ttl, self.negative_ttl) / 2))
+            now = monotonic()
+            with self._lock:
+                for host in [h for h, e in self._entries.items() if now - e.last_used > _IDLE_SECONDS]:
+                    del self._entries[host]
+                due = [(h, e) for h, e in self._entries.items() if e.expires - now < self.ttl / 2]
+            for host, entry in due:
+                self.__refresh(host, entry)
+
+    def __after_fork(self):
+        # The refresh thread does not exist in a forked child, the next lookup starts a new one
+        self._lock = threading.Lock()
+        self._refresher = None
+
+
+resolver = Resolver()
+
+
+# HOST_IPS (comma separated) or HOST_IP pin the addresses of a host and skip DNS
+def _override(host: str) -> List[str]:
+    prefix = host.upper().replace('-', '_')
+    env_var = os.getenv(f"{prefix}_IPS") or os.getenv(f"{prefix}_IP") or ""
+    return [ip.strip() for ip in env_var.split(",") if ip.strip()]
 
-_cache = {}
 
 def resolve(host: str) -> str:
-    env_var = os.getenv(f"{host.upper().replace('-', '_')}_IP")
-    if env_var: 
-        return env_var
-    
-    if host in _cache: 
-        return _cache[host]
-    
-    last_err = None 
-    for _ in range(3):
-        try: 
-            ip = socket.gethostbyname(host)
-            _cache[host] = ip 
-            return ip 
-        except socket.gaierror as e: 
-            last_err = e
-            time.sleep(1)
-
-    raise last_err
\ No newline at end of file
+    return resolve_all(host)[0]
+
+
+# Every IPv4 address of a host, a compose service scaled to several containers has one per replica
+def resolve_all(host: str) -> List[str]:
+    return _override(host) or resolver.resolve_all(host)
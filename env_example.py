@@ -2,3 +2,5 @@ MANAGER_API = 'https://manager.kliker.biz'
 SEND_PROMPT_RESULT_ROUTE = '/api/prompt/send_prompt_task_result'
 PROMPT_TOKEN = ''
 SERVER_TOKEN = ''
+# Optional, the outbox posts up to OUTBOX_BATCH_SIZE results per request when set
+SEND_PROMPT_RESULTS_BATCH_ROUTE = ''
@@ -0,0 +1,109 @@
+import os
+import dns
+import requests
+import threading
+
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Kept apart from the 600 s job timeout: a dead host should fail the attempt in seconds
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+MODEL_SERVER_READ_TIMEOUT = float(os.getenv("MODEL_SERVER_READ_TIMEOUT", "540"))
+MANAGER_READ_TIMEOUT = float(os.getenv("MANAGER_READ_TIMEOUT", "30"))
+
+POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+
+http_client_requests = Counter("http_client_requests", "Outbound HTTP requests sent through the shared client", ["host"])
+http_client_connections_opened = Counter("http_client_connections_opened", "New TCP connections opened by the shared client, requests minus this is connection reuse", ["host"])
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        http_client_connections_opened.labels(self.host).inc()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        http_client_connections_opened.labels(self.host).inc()
+        return super()._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+_session = None
+_lock = threading.Lock()
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    # pool_block bounds the connections per host instead of opening throwaway extras
+    adapter = _PooledAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE, pool_block=True, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _new_session()
+    return _session
+
+
+def _drop_session():
+    # Sockets inherited from the parent must not be shared with a forked child
+    global _session
+    _session = None
+
+
+os.register_at_fork(after_in_child=_drop_session)
+
+
+# Pooled keep-alive connections to an address DNS no longer returns would outlive the container
+def close_host(host: str):
+    session = _session
+    if session is None:
+        return
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            if key.key_host == host:
+                try:
+                    del pools[key]
+                except KeyError:
+                    pass
+
+
+def _on_address_change(host: str, old, new):
+    for address in set(old) - set(new):
+        close_host(address)
+
+
+dns.resolver.on_change(_on_address_change)
+
+
+def timeout(read_timeout: float):
+    return (CONNECT_TIMEOUT, read_timeout)
+
+
+def post(url: str, read_timeout: float, **kwargs) -> requests.Response:
+    http_client_requests.labels(urlsplit(url).hostname).inc()
+    return get_session().post(url, timeout=timeout(read_timeout), **kwargs)
+
+
+def get(url: str, read_timeout: float, **kwargs) -> requests.Response:
+    http_client_requests.labels(urlsplit(url).hostname).inc()
+    return get_session().get(url, timeout=timeout(read_timeout), **kwargs)
@@ -0,0 +1,129 @@
+import json
+import random
+from time import perf_counter
+from extractor import extract_json_from_str, is_escaped
+
+# Throughput of extract_json_from_str on the kind of text the model actually returns.
+# Needs no model, run from this directory: python bench.py [repeats]
+
+random.seed(7)
+
+WORDS = "the invoice total amount shows a stamp near header page line item signed dated vendor".split()
+
+
+def prose(n_words: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(n_words))
+
+
+def ocr_line() -> str:
+    # OCR output is full of quotes, backslashes and stray braces that end up escaped inside JSON strings
+    return random.choice([
+        'C:\\scans\\2024\\inv "final" {copy}',
+        'total: 1\\\\2 [approx] "EUR"',
+        '\\\\server\\share\\{id}\\"x"',
+        'he said "ok" \\ then left',
+    ])
+
+
+def answer(i: int) -> dict:
+    return {
+        "document_type": random.choice(["invoice", "receipt", "letter"]),
+        "page": i,
+        "confident": random.random() > 0.5,
+        "total": round(random.random() * 1000, 2),
+        "items": [{"name": prose(3), "qty": random.randint(1, 9)} for _ in range(5)],
+    }
+
+
+def case_prose_around_json() -> str:
+    return prose(400) + "\n```json\n" + json.dumps(answer(1), indent=2) + "\n```\n" + prose(400)
+
+
+def case_escaped_ocr_text() -> str:
+    obj = {"text": "\n".join(ocr_line() for _ in range(2000)), "lines": 2000}
+    return "Here is the transcription:\n" + json.dumps(obj) + "\nLet me know if you need more."
+
+
+def case_truncated_objects() -> str:
+    # Generation cut off by max tokens, plus an unbalanced brace in the prose before the answer
+    text = "Result {see below:\n" + json.dumps(answer(1)) + "\n"
+    return text + json.dumps(answer(2))[:-40] + " " + prose(200)
+
+
+def case_many_small_objects() -> str:
+    return "\n".join(f"row {i}: " + json.dumps({"id": i, "ok": i % 3 == 0, "label": prose(2)}) for i in range(2000))
+
+
+def case_backslash_runs() -> str:
+    # Worst case for scanning back from every quote: each quote sits behind a long run of backslashes
+    value = ("\\" * 200 + '"') * 200
+    return json.dumps({"value": value})
+
+
+cases = [
+    ("Prose around JSON", case_prose_around_json()),
+    ("Escaped OCR text", case_escaped_ocr_text()),
+    ("Truncated objects", case_truncated_objects()),
+    ("Many small objects", case_many_small_objects()),
+    ("Backslash runs", case_backslash_runs()),
+]
+
+
+# The previous implementation, kept here as the baseline for the numbers and results below
+def reference_extract(text: str):
+    results = []
+    start_idx = None
+    stack = []
+    in_string = False
+
+    for i, char in enumerate(text):
+        if char == '"' and not is_escaped(text, i):
+            in_string = not in_string
+            continue
+
+        if char in {'{', '['} and not in_string:
+            if not stack:
+                start_idx = i
+            stack.append(char)
+        elif char in {'}', ']'} and not in_string:
+            if stack:
+                opening_char = stack.pop()
+                if (opening_char == '{' and char != '}') or (opening_char == '[' and char != ']'):
+                    stack.clear()
+                    continue
+
+                if not stack and start_idx is not None:
+                    try:
+                        results.append(json.loads(text[start_idx:i+1].strip()))
+                    except json.JSONDecodeError:
+                        pass
+                    start_idx = None
+
+    if len(results) == 0:
+        return None
+    elif len(results) == 1:
+        return results[0]
+    return results
+
+
+def throughput(fn, text: str, repeats: int) -> float:
+    fn(text)
+    start = perf_counter()
+    for _ in range(repeats):
+        fn(text)
+    elapsed = perf_counter() - start
+    return len(text) * repeats / elapsed / 1024 / 1024
+
+
+if __name__ == "__main__":
+    import sys
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print(f"{'CASE':<22}{'SIZE KB':>10}{'MB/s':>10}{'BASELINE MB/s':>16}{'SPEEDUP':>10}  SAME RESULT")
+    print("-" * 82)
+    for name, text in cases:
+        current = throughput(extract_json_from_str, text, repeats)
+        baseline = throughput(reference_extract, text, repeats)
+        same = extract_json_from_str(text) == reference_extract(text)
+        status = "✅" if same else "❌"
+        print(f"{name:<22}{len(text) / 1024:>10.1f}{current:>10.1f}{baseline:>16.1f}{current / baseline:>9.1f}x  {status}")
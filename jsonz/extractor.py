@@ -1,5 +1,6 @@
+import re
 import json 
-from typing import Union
+from typing import Union, Callable, Optional
 
 def is_escaped(text: str, char_pos: int) -> bool: 
     count  = 0
@@ -9,42 +10,115 @@ def is_escaped(text: str, char_pos: int) -> bool:
         idx -= 1 
     return count % 2 == 1
 
+# One token per string literal, bracket or backslash pair outside a string. A string runs to its first
+# quote not preceded by an odd run of backslashes (or to the end of the text), so escape parity comes out
+# of the single left-to-right pass instead of scanning back from every quote, and string contents and
+# plain text are skipped inside the regex engine.
+_TOKENS = re.compile(r'"(?:[^"\\]+|\\.)*"?|\\[\\"]|[{}\[\]]', re.DOTALL)
+_PAIRS = {'}': '{', ']': '['}
+_decoder = json.JSONDecoder()
+
+# Parses the balanced block text[start:end] where it lies instead of slicing it out first
+def _parse_in_place(text: str, start: int, end: int) -> Union[list, dict, None]: 
+    try: 
+        parsed, stop = _decoder.raw_decode(text, start)
+    except json.JSONDecodeError:
+        return None 
+
+    return parsed if stop == end else None
+
 def extract_json_from_str(text: str) -> Union[list, dict, None]: 
     results = []
     start_idx = None 
     stack = []
-    in_string = False 
 
-    for i, char in enumerate(text):
-        if char == '"' and not is_escaped(text, i): 
-            in_string = not in_string
+    for match in _TOKENS.finditer(text):
+        start, end = match.span()
+        char = text[start]
+        if end - start != 1 or char == '"': 
             continue
         
-        if char in {'{', '['} and not in_string: 
+        if char in {'{', '['}: 
             if not stack: 
-                start_idx = i
+                start_idx = start
             stack.append(char)
-        elif char in {'}', ']'} and not in_string:
-            if stack: 
-                opening_char = stack.pop()
-                if (opening_char == '{' and char != '}') or (opening_char == '[' and char != ']'):
-                    stack.clear()
-                    continue
+        elif stack: 
+            opening_char = stack.pop()
+            if opening_char != _PAIRS[char]:
+                stack.clear()
+                continue
 
-                if not stack and start_idx is not None: 
-                    json_candidate = text[start_idx:i+1].strip()
-                    try: 
-                        results.append(json.loads(json_candidate))
-                    except json.JSONDecodeError:
-                        pass 
+            if not stack and start_idx is not None: 
+                parsed = _parse_in_place(text, start_idx, end)
+                if parsed is not None: 
+                    results.append(parsed)
 
-                    start_idx = None 
+                start_idx = None 
 
-    
-    
     if len(results) == 0:
         return None 
     elif (len(results)) == 1: 
         return results[0]
 
-    return results 
\ No newline at end of file
+    return results 
+
+
+# Incremental variant for streamed model output: feed() chunks as they are generated and stop
+# as soon as the first balanced top-level object parses and is accepted
+class JsonStreamExtractor: 
+    def __init__(self, accept: Optional[Callable[[dict], bool]] = None):
+        self.accept = accept
+        self.text = ""
+        self.result = None
+        self.rejected = 0
+
+        self._start_idx = None
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> Optional[dict]: 
+        if self.result is not None: 
+            return self.result
+
+        offset = len(self.text)
+        self.text += chunk
+
+        for i, char in enumerate(chunk, start=offset):
+            escaped = self._escaped
+            self._escaped = char == "\\" and not escaped
+
+            if char == '"' and not escaped: 
+                self._in_string = not self._in_string
+                continue
+
+            if self._in_string: 
+                continue
+
+            if char in {'{', '['}: 
+                if not self._stack: 
+                    self._start_idx = i
+                self._stack.append(char)
+            elif char in {'}', ']'} and self._stack: 
+                opening_char = self._stack.pop()
+                if (opening_char == '{' and char != '}') or (opening_char == '[' and char != ']'):
+                    self._stack.clear()
+                    continue
+
+                if not self._stack and self._start_idx is not None: 
+                    start_idx, self._start_idx = self._start_idx, None
+                    if self.__try_accept(_parse_in_place(self.text, start_idx, i + 1)): 
+                        return self.result
+
+        return None
+
+    def __try_accept(self, parsed: Union[list, dict, None]) -> bool: 
+        if not isinstance(parsed, dict): 
+            return False
+
+        if self.accept is not None and not self.accept(parsed): 
+            self.rejected += 1
+            return False
+
+        self.result = parsed
+        return True
@@ -0,0 +1,81 @@
+import json
+from typing import List
+# Importable both as jsonz.grammar and from inside jsonz/ like the other modules here
+try: 
+    from .validator import SCHEMA_TYPES, compile_schema, parse_type_name
+except ImportError: 
+    from validator import SCHEMA_TYPES, compile_schema, parse_type_name
+
+# Turns the schema DSL into a llama.cpp GBNF grammar, so the sampler can only produce objects
+# that validate: every key in schema order, floats with a decimal point, `?` types as `| null`.
+# Numbers and whitespace are bounded so a constrained sample cannot run away.
+_BASE_RULES = r'''
+ws ::= | " " | "\n" [ \t]{0,20}
+string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F]{4}) )* "\"" ws
+integer ::= "-"? ("0" | [1-9] [0-9]{0,15}) ws
+float ::= "-"? ("0" | [1-9] [0-9]{0,15}) "." [0-9]{1,15} ([eE] [-+]? [0-9]{1,3})? ws
+number ::= "-"? ("0" | [1-9] [0-9]{0,15}) ("." [0-9]{1,15})? ([eE] [-+]? [0-9]{1,3})? ws
+boolean ::= ("true" | "false") ws
+null ::= "null" ws
+value ::= object | array | string | number | boolean | null
+object ::= "{" ws ( string ":" ws value ("," ws string ":" ws value)* )? "}" ws
+array ::= "[" ws ( value ("," ws value)* )? "]" ws
+'''
+
+# Any single object, used when a request has no schema
+JSON_OBJECT_GBNF = "root ::= object\n" + _BASE_RULES
+
+_TYPE_RULES = {
+    str: "string",
+    int: "integer",
+    float: "float",
+    bool: "boolean",
+    list: "array",
+}
+
+
+def _literal(text: str) -> str: 
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class _GrammarBuilder: 
+    def __init__(self):
+        self.rules = []
+
+    def __new_rule(self, body: str) -> str: 
+        name = f"node-{len(self.rules)}"
+        self.rules.append(f"{name} ::= {body}")
+        return name
+
+    def object_rule(self, schema: dict) -> str: 
+        members = []
+        for key, expected_type in schema.items(): 
+            members.append(f'{_literal(json.dumps(key))} ws ":" ws {self.value_expr(expected_type)}')
+
+        if not members: 
+            return self.__new_rule('"{" ws "}" ws')
+        return self.__new_rule('"{" ws ' + ' "," ws '.join(members) + ' "}" ws')
+
+    def value_expr(self, expected_type) -> str: 
+        if isinstance(expected_type, dict): 
+            return self.object_rule(expected_type)
+
+        if isinstance(expected_type, list): 
+            if len(expected_type) == 0 or not isinstance(expected_type[0], dict): 
+                return "array"
+            item = self.object_rule(expected_type[0])
+            return self.__new_rule(f'"[" ws ( {item} ("," ws {item})* )? "]" ws')
+
+        type_name, optional = parse_type_name(expected_type)
+        rule = _TYPE_RULES[SCHEMA_TYPES[type_name]]
+        return f"( {rule} | null )" if optional else rule
+
+
+# Raises SchemaError for the same schemas compile_schema rejects
+def schema_to_gbnf(schema: dict) -> str: 
+    compile_schema(schema)
+
+    builder = _GrammarBuilder()
+    root = builder.object_rule(schema)
+    lines: List[str] = [f"root ::= {root}"] + builder.rules
+    return "\n".join(lines) + "\n" + _BASE_RULES
@@ -1,5 +1,6 @@
-from extractor import extract_json_from_str
-from validator import is_valid_json
+from extractor import extract_json_from_str, JsonStreamExtractor
+from validator import is_valid_json, compile_schema, SchemaError
+from grammar import schema_to_gbnf, JSON_OBJECT_GBNF
 
 tests = [
     {
@@ -106,6 +107,58 @@ for test in tests:
     print("-" * 60)
 
 
+# --------------------------------------------------------------------
+# Tests for compile_schema (failing paths and malformed schemas)
+
+violation_tests = [
+    {
+        "name": "All failing paths are reported",
+        "schema": {"dog": "bool", "data": {"type": "str"}, "logs": [{"ts": "int"}]},
+        "data": {"dog": 1, "data": {"type": None}, "logs": [{"ts": 1}, {}]},
+        "expect": ["$.dog", "$.data.type", "$.logs[1].ts"],
+    },
+    {
+        "name": "Type strings are normalised once",
+        "schema": {"name": " STR? "},
+        "data": {"name": None},
+        "expect": [],
+    },
+]
+
+print("\nRunning schema violation tests")
+for test in violation_tests:
+    paths = [violation.path for violation in compile_schema(test["schema"]).validate(test["data"])]
+    passed = paths == test["expect"]
+    status = "✅ PASS" if passed else "❌ FAIL"
+    print(f"TEST: {test['name']}")
+    print(f"STATUS: {status}")
+    if not passed:
+        print("Expected:", test["expect"])
+        print("Got     :", paths)
+    print("-" * 60)
+
+malformed_schemas = [
+    ("Unknown type name", {"price": "money"}),
+    ("Unsupported schema value", {"count": 5}),
+    ("Schema is not an object", ["str"]),
+]
+
+for name, schema in malformed_schemas:
+    try:
+        compile_schema(schema)
+        passed = False
+    except SchemaError:
+        passed = True
+    status = "✅ PASS" if passed else "❌ FAIL"
+    print(f"TEST: {name}")
+    print(f"STATUS: {status}")
+    print("-" * 60)
+
+passed = compile_schema({"a": "int", "b": "str"}) is compile_schema({"b": "str", "a": "int"})
+print("TEST: Compiled schema is cached by canonical hash")
+print(f"STATUS: {'✅ PASS' if passed else '❌ FAIL'}")
+print("-" * 60)
+
 # --------------------------------------------------------------------
 # Tests for extract_json_from_str (improved version)
 
@@ -185,6 +238,21 @@ extract_tests = [
         "text": "\"{\\\"foo\\\": 1}\"",
         "expect": None,
     },
+    {
+        "name": "Escaped backslash before closing quote",
+        "text": "{\"path\": \"C:\\\\\"} {\"b\": 1}",
+        "expect": [{"path": "C:\\"}, {"b": 1}],
+    },
+    {
+        "name": "Unterminated string swallows the rest",
+        "text": "{\"a\": 1} \"open {\"b\": 2}",
+        "expect": {"a": 1},
+    },
+    {
+        "name": "Mismatched bracket resets the block",
+        "text": "{\"a\": [1} {\"b\": 2}",
+        "expect": {"b": 2},
+    },
 ]
 
 print("\nRunning updated extraction tests")
@@ -197,4 +265,127 @@ for test in extract_tests:
     if not passed:
         print("Expected:", test["expect"])
         print("Got     :", result)
-    print("-" * 60)
\ No newline at end of file
+    print("-" * 60)
+
+
+# --------------------------------------------------------------------
+# Tests for JsonStreamExtractor (chunks arrive like streamed tokens)
+
+stream_tests = [
+    {
+        "name": "Object split across chunks, trailing text never read",
+        "chunks": ["Sure! {\"a", "\": 1, \"b\"", ": \"x}\"}", " and some commentary", " {\"c\": 2}"],
+        "expect": {"a": 1, "b": "x}"},
+        "expect_chunks_read": 3,
+    },
+    {
+        "name": "Skips arrays and invalid objects",
+        "chunks": ["[1, 2] {foo:1} ", "{\"ok\": true}"],
+        "expect": {"ok": True},
+        "expect_chunks_read": 2,
+    },
+    {
+        "name": "Rejected by schema, next object accepted",
+        "chunks": ["{\"price\": \"cheap\"} ", "{\"price\": 1.5}"],
+        "schema": {"price": "float"},
+        "expect": {"price": 1.5},
+        "expect_chunks_read": 2,
+    },
+    {
+        "name": "Escaped quote split across chunks",
+        "chunks": ["{\"t\": \"a\\", "\"b\"}"],
+        "expect": {"t": "a\"b"},
+        "expect_chunks_read": 2,
+    },
+    {
+        "name": "Truncated object",
+        "chunks": ["{\"a\": 1, ", "\"b\": "],
+        "expect": None,
+        "expect_chunks_read": 2,
+    },
+]
+
+print("\nRunning streaming extraction tests")
+for test in stream_tests:
+    schema = test.get("schema")
+    extractor = JsonStreamExtractor(accept=(lambda obj: is_valid_json(schema, obj)) if schema else None)
+
+    chunks_read = 0
+    for chunk in test["chunks"]:
+        chunks_read += 1
+        if extractor.feed(chunk) is not None:
+            break
+
+    passed = extractor.result == test["expect"] and chunks_read == test["expect_chunks_read"]
+    status = "✅ PASS" if passed else "❌ FAIL"
+    print(f"TEST: {test['name']}")
+    print(f"STATUS: {status}")
+    if not passed:
+        print("Expected:", test["expect"], "after", test["expect_chunks_read"], "chunks")
+        print("Got     :", extractor.result, "after", chunks_read, "chunks")
+    print("-" * 60)
+
+
+# --------------------------------------------------------------------
+# Tests for schema_to_gbnf (fragments the generated grammar must contain)
+
+grammar_tests = [
+    {
+        "name": "Optional field allows null",
+        "schema": {"bio": "str?"},
+        "expect": ['"\\"bio\\"" ws ":" ws ( string | null )'],
+    },
+    {
+        "name": "Float requires a decimal point",
+        "schema": {"price": "Float"},
+        "expect": ['ws float "}"', 'float ::= "-"? ("0" | [1-9] [0-9]{0,15}) "."'],
+    },
+    {
+        "name": "List of objects uses the item rule",
+        "schema": {"logs": [{"ts": "int"}]},
+        "expect": ['node-0 ::= "{" ws "\\"ts\\"" ws ":" ws integer "}" ws', '"[" ws ( node-0 ("," ws node-0)* )? "]" ws'],
+    },
+]
+
+print("\nRunning grammar tests")
+for test in grammar_tests:
+    gbnf = schema_to_gbnf(test["schema"])
+    missing = [fragment for fragment in test["expect"] if fragment not in gbnf]
+    status = "✅ PASS" if not missing else "❌ FAIL"
+    print(f"TEST: {test['name']}")
+    print(f"STATUS: {status}")
+    if missing:
+        print("Missing :", missing)
+        print("Grammar :", gbnf)
+    print("-" * 60)
+
+try:
+    schema_to_gbnf({"price": "money"})
+    passed = False
+except SchemaError:
+    passed = True
+print("TEST: Grammar rejects malformed schema")
+print(f"STATUS: {'✅ PASS' if passed else '❌ FAIL'}")
+print("-" * 60)
+
+# Every generated grammar has to parse in llama.cpp, LlamaGrammar itself does not check them
+try:
+    import llama_cpp
+except ImportError:
+    llama_cpp = None
+
+print("\nRunning grammar parse tests")
+if llama_cpp is None:
+    print("Skipped, llama-cpp-python is not installed")
+else:
+    grammars = [("Plain JSON object", JSON_OBJECT_GBNF)]
+    grammars += [(test["name"], schema_to_gbnf(test["schema"])) for test in tests + grammar_tests + violation_tests]
+    for name, gbnf in grammars:
+        sampler = llama_cpp.llama_sampler_init_grammar(None, gbnf.encode("utf-8"), b"root")
+        print(f"TEST: {name} grammar parses")
+        print(f"STATUS: {'✅ PASS' if sampler else '❌ FAIL'}")
+        if sampler:
+            llama_cpp.llama_sampler_free(sampler)
+        else:
+            print("Grammar :", gbnf)
+        print("-" * 60)
\ No newline at end of file
@@ -1,4 +1,8 @@
-from typing import Union 
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, List, NamedTuple, Optional, Tuple, Union 
 
 SCHEMA_TYPES = {
     'str': str, 
@@ -15,55 +19,148 @@ SCHEMA_TYPES = {
     'array': list 
 }
 
-def is_valid_json(schema: dict, json_obj: Union[list, dict]) -> bool:
-    for key, expected_type in schema.items():    
-        if key not in json_obj: 
-            print("Missing required field:  ", key, " not part of json object ")
-            return False 
-        
-        value = json_obj[key]
-        if isinstance(expected_type, dict):
-            if not isinstance(value, dict) or not is_valid_json(expected_type, value):
-                return False 
-        elif isinstance(expected_type, list):
-            if not isinstance(value, list):
-                print("Expected list at key: ", key)
-                return False 
-            
-            if len(expected_type) == 0: 
-                continue
+MAX_COMPILED_SCHEMAS = 256
 
-            item_schema = expected_type[0]
-            if not isinstance(item_schema, dict):
-                continue
-            
-            for i, item in enumerate(value):
-                if not isinstance(item, dict) or not is_valid_json(item_schema, item):
-                    print("Invalid item at ", key[i])
-                    return False 
-            
-        elif isinstance(expected_type, str): 
-            expected_type = expected_type.strip()
-            is_optional = expected_type.endswith('?')
-            expected_type = expected_type.rstrip('?').lower()
-
-            if is_optional and value is None: 
+
+class SchemaError(ValueError): 
+    pass
+
+
+class SchemaViolation(NamedTuple): 
+    path: str
+    reason: str
+
+
+# Schema nodes are built once per schema, type strings like " Str? " are resolved at compile time
+class _TypeNode: 
+    def __init__(self, type_name: str, python_type: type, optional: bool):
+        self.type_name = type_name
+        self.python_type = python_type
+        self.optional = optional
+
+    def check(self, value: Any, path: str, errors: List[SchemaViolation]): 
+        if value is None: 
+            if not self.optional: 
+                errors.append(SchemaViolation(path, "non-optional field is null"))
+            return
+
+        if not isinstance(value, self.python_type): 
+            errors.append(SchemaViolation(path, f"expected {self.type_name}, got {type(value).__name__}"))
+
+
+class _ListNode: 
+    def __init__(self, item: Optional["_ObjectNode"]):
+        self.item = item
+
+    def check(self, value: Any, path: str, errors: List[SchemaViolation]): 
+        if not isinstance(value, list): 
+            errors.append(SchemaViolation(path, f"expected list, got {type(value).__name__}"))
+            return
+
+        if self.item is None: 
+            return
+
+        for i, item in enumerate(value): 
+            self.item.check(item, f"{path}[{i}]", errors)
+
+
+class _ObjectNode: 
+    def __init__(self, fields: List[tuple]):
+        self.fields = fields
+
+    def check(self, value: Any, path: str, errors: List[SchemaViolation]): 
+        if not isinstance(value, dict): 
+            errors.append(SchemaViolation(path, f"expected object, got {type(value).__name__}"))
+            return
+
+        for key, node in self.fields: 
+            field_path = f"{path}.{key}"
+            if key not in value: 
+                errors.append(SchemaViolation(field_path, "missing required field"))
                 continue
+            node.check(value[key], field_path, errors)
+
+
+# " Str? " -> ("str", True)
+def parse_type_name(expected_type: str) -> Tuple[str, bool]: 
+    type_name = expected_type.strip()
+    optional = type_name.endswith('?')
+    return type_name.rstrip('?').lower(), optional
 
-            if not is_optional and value is None: 
-                print("Non-optional key", key, ' is null')
-                return False 
-
-            if expected_type not in SCHEMA_TYPES: 
-                print("Expected type: ", expected_type, " not part of valid schema types")
-                return False 
-    
-            python_type = SCHEMA_TYPES[expected_type]
-            if not isinstance(value, python_type): 
-                print("Type mismatch at ", key, ' ,expected ', python_type, " got " , type(value))
-                return False     
-        else: 
-            print("Unsupported schema type for key", key)
-            return False 
-
-    return True 
\ No newline at end of file
+
+def _compile_node(expected_type: Any, path: str): 
+    if isinstance(expected_type, dict): 
+        return _ObjectNode([(key, _compile_node(sub_type, f"{path}.{key}")) for key, sub_type in expected_type.items()])
+
+    if isinstance(expected_type, list): 
+        # Only the first entry describes the items and only object items are checked, same as before
+        if len(expected_type) == 0 or not isinstance(expected_type[0], dict): 
+            return _ListNode(None)
+        return _ListNode(_compile_node(expected_type[0], f"{path}[]"))
+
+    if isinstance(expected_type, str): 
+        type_name, optional = parse_type_name(expected_type)
+        if type_name not in SCHEMA_TYPES: 
+            raise SchemaError(f"{path}: unknown type {expected_type!r}, expected one of {', '.join(SCHEMA_TYPES)}")
+        return _TypeNode(type_name, SCHEMA_TYPES[type_name], optional)
+
+    raise SchemaError(f"{path}: unsupported schema value {expected_type!r}")
+
+
+class CompiledSchema: 
+    def __init__(self, schema: dict, schema_hash: str):
+        if not isinstance(schema, dict): 
+            raise SchemaError(f"schema must be an object, got {type(schema).__name__}")
+
+        self.schema = schema
+        self.hash = schema_hash
+        self._root = _compile_node(schema, "$")
+
+    # Every failing path, an empty list means the object is valid
+    def validate(self, json_obj: Union[list, dict]) -> List[SchemaViolation]: 
+        errors = []
+        self._root.check(json_obj, "$", errors)
+        return errors
+
+    def is_valid(self, json_obj: Union[list, dict]) -> bool: 
+        return len(self.validate(json_obj)) == 0
+
+
+def schema_hash(schema: dict) -> str: 
+    try: 
+        canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except (TypeError, ValueError) as e: 
+        raise SchemaError(f"schema is not JSON serializable: {e}")
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+# Compiles a schema once per canonical hash, raises SchemaError for schemas that could never validate
+def compile_schema(schema: dict) -> CompiledSchema: 
+    key = schema_hash(schema)
+    with _compiled_lock: 
+        compiled = _compiled.get(key)
+        if compiled is not None: 
+            _compiled.move_to_end(key)
+            return compiled
+
+    compiled = CompiledSchema(schema, key)
+    with _compiled_lock: 
+        _compiled[key] = compiled
+        while len(_compiled) > MAX_COMPILED_SCHEMAS: 
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def validate(schema: dict, json_obj: Union[list, dict]) -> List[SchemaViolation]: 
+    return compile_schema(schema).validate(json_obj)
+
+
+def is_valid_json(schema: dict, json_obj: Union[list, dict]) -> bool:
+    try: 
+        return compile_schema(schema).is_valid(json_obj)
+    except SchemaError: 
+        return False 
\ No newline at end of file
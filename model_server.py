@@ -1,31 +1,166 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
+import os
+import threading
+import traceback
+from time import perf_counter
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field, field_validator
 from vision.cpp import ImageInference
 from typing import List, Optional, Dict, Any
+from vision.scheduler import InferenceScheduler, SchedulerFull
+from jsonz.validator import compile_schema
+from prometheus_client import Gauge
+from prometheus_fastapi_instrumentator import Instrumentator
 
-app = FastAPI()
+MODEL_SLOTS = int(os.getenv("MODEL_SLOTS", "1"))
+MODEL_QUEUE_LIMIT = int(os.getenv("MODEL_QUEUE_LIMIT", "16"))
+# Warm-up passes with a generated image before the server reports ready, 0 skips the warm-up
+MODEL_WARMUP = int(os.getenv("MODEL_WARMUP", "1"))
+MODEL_WARMUP_PROMPT = os.getenv("MODEL_WARMUP_PROMPT", "Describe the product in the image as a JSON object.")
+# The evaluated state of this system prompt is cached before the first request
+MODEL_WARMUP_SYSTEM_PROMPT = os.getenv("MODEL_WARMUP_SYSTEM_PROMPT") or None
 
-# Load the vision model once on startup
-model = ImageInference()
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+model_startup_seconds = Gauge("model_startup_seconds", "Duration of each model server startup phase", ["phase"])
+model_ready = Gauge("model_ready", "1 once the model is loaded and warmed up")
+
+# Filled in by the loader thread, requests are turned away until the scheduler exists
+startup = {"status": LOADING, "phases": {}, "error": None}
+model: Optional[ImageInference] = None
+scheduler: Optional[InferenceScheduler] = None
+
+
+@contextmanager
+def _phase(name: str):
+    print(f"[MODEL] Startup phase {name}…", flush=True)
+    start = perf_counter()
+    yield
+    seconds = round(perf_counter() - start, 3)
+    startup["phases"][name] = seconds
+    model_startup_seconds.labels(name).set(seconds)
+    print(f"[MODEL] Startup phase {name} took {seconds}s", flush=True)
+
+
+def _warm_up(slot: ImageInference):
+    for i in range(MODEL_WARMUP):
+        try:
+            timings = slot.warm_up(MODEL_WARMUP_PROMPT, MODEL_WARMUP_SYSTEM_PROMPT)
+            print(f"[MODEL] Warm-up pass {i + 1}: {timings}", flush=True)
+        except Exception as e:
+            # A loaded model still serves, only the first requests are slower
+            print("[MODEL] Warm-up failed:", e, flush=True)
+            return
+
+
+def _load():
+    global model, scheduler
+    try:
+        start = perf_counter()
+        # Every extra slot loads the model again with its own share of the CPU threads, see MODEL_SLOTS in the readme
+        with _phase("load_model"):
+            model = ImageInference(n_threads=max(1, os.cpu_count() // MODEL_SLOTS))
+        startup["phases"].update(model.load_timings)
+        with _phase("load_slots"):
+            slots = [model] + [model.new_slot() for _ in range(MODEL_SLOTS - 1)]
+
+        # Weights, kernels and the projector are shared, warming the first slot warms the process
+        startup["status"] = WARMING
+        with _phase("warm_up"):
+            _warm_up(slots[0])
+
+        scheduler = InferenceScheduler(slots, max_queue=MODEL_QUEUE_LIMIT)
+        startup["phases"]["total"] = round(perf_counter() - start, 3)
+        startup["status"] = READY
+        model_ready.set(1)
+        print(f"[MODEL] Ready after {startup['phases']['total']}s", flush=True)
+    except Exception as e:
+        startup["status"] = FAILED
+        startup["error"] = str(e)
+        print("[MODEL] Startup failed:", e, flush=True)
+        print("Stack: ", traceback.format_exc(), flush=True)
+
+
+# uvicorn accepts connections right away, the model loads next to it
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=_load, name="model-loader", daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Request metrics plus the per-stage histograms of vision.cpp on /metrics
+Instrumentator().instrument(app).expose(app)
+
+Gauge("model_slots_busy", "Model slots running an inference").set_function(lambda: scheduler.busy if scheduler else 0)
+Gauge("model_requests_queued", "Requests waiting for a model slot").set_function(lambda: scheduler.queued if scheduler else 0)
 
 class InferenceRequest(BaseModel):
     prompt: str
-    system_prompt: str 
+    system_prompt: str
     images: List[str]
-    expected_json_schema: Optional[Dict[str, Any]] = None 
+    expected_json_schema: Optional[Dict[str, Any]] = None
+    # Lowers IMAGE_MAX_SLICES for this request, 0 encodes the overview only
+    max_slices: Optional[int] = Field(default=None, ge=0)
+
+    # A schema no output can satisfy is a 422 here instead of nine failed samples later
+    @field_validator("expected_json_schema")
+    @classmethod
+    def check_schema(cls, schema):
+        if schema:
+            compile_schema(schema)
+        return schema
 
 class InferenceResponse(BaseModel):
     result: dict | None
+    timings: Optional[Dict[str, Any]] = None
 
 @app.post("/infer", response_model=InferenceResponse)
-def infer(req: InferenceRequest):
-    result = model.prompt(req.prompt, req.system_prompt, req.images, req.expected_json_schema)
-    return {"result": result}
+async def infer(req: InferenceRequest):
+    if scheduler is None:
+        raise HTTPException(status_code=503, detail=f"Model {startup['status']}")
 
+    def run(slot: ImageInference):
+        result = slot.prompt(req.prompt, req.system_prompt, req.images, req.expected_json_schema, req.max_slices)
+        return {"result": result, "timings": slot.last_timings}
+
+    try:
+        return await scheduler.run(run)
+    except SchedulerFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/capacity")
+def get_capacity():
+    if scheduler is None:
+        # Workers hold their jobs back until the model is warm
+        return {"status": startup["status"], "slots": MODEL_SLOTS, "busy": 0, "queued": 0, "max_queue": MODEL_QUEUE_LIMIT, "saturated": True}
+    return {"status": READY, **scheduler.snapshot()}
+
+@app.get("/stats")
+def stats():
+    if model is None:
+        raise HTTPException(status_code=503, detail=f"Model {startup['status']}")
+    return {
+        "prefix_cache": model.prefix_cache.stats(),
+        "image_embed_cache": model.embed_cache.stats(),
+        "grammar_cache": model.grammar_cache.stats(),
+    }
+
+# Liveness, the process is up while the model is still loading
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+# Readiness, 503 until the model is loaded and warmed up
+@app.get("/ready")
+def ready():
+    return JSONResponse(startup, status_code=200 if startup["status"] == READY else 503)
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,213 @@
+import os
+import env
+import json
+import random
+import socket
+import http_client
+from time import sleep, time
+from redis import Redis
+from redis.exceptions import ConnectionError
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter, Gauge, start_http_server
+
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+MIN_BACKOFF = float(os.getenv("OUTBOX_MIN_BACKOFF", "2"))
+MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "300"))
+DEAD_LETTER_MAX = int(os.getenv("OUTBOX_DEAD_LETTER_MAX", "10000"))
+# The manager has no contract for failed tasks yet, until then they are only kept in the dead letter list
+DELIVER_ERRORS = os.getenv("OUTBOX_DELIVER_ERRORS", "0") == "1"
+METRICS_PORT = int(os.getenv("OUTBOX_METRICS_PORT", "8002"))
+
+# Optional manager route that takes a list of results in one request
+BATCH_ROUTE = getattr(env, "SEND_PROMPT_RESULTS_BATCH_ROUTE", None)
+
+_PENDING = "vision:outbox"
+_RETRY = "vision:outbox:retry"
+_DEAD = "vision:outbox:dead"
+_PROCESSING_PREFIX = "vision:outbox:processing:"
+
+outbox_delivered = Counter("outbox_delivered", "Results delivered to the manager API")
+outbox_retries = Counter("outbox_retries", "Failed result deliveries scheduled for another attempt")
+outbox_dead_lettered = Counter("outbox_dead_lettered", "Results given up on and moved to the dead letter list", ["reason"])
+outbox_pending = Gauge("outbox_pending", "Results waiting for delivery, retries included")
+
+# Due retries go back to the front of the pending list
+_PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, entry in ipairs(due) do
+    redis.call('RPUSH', KEYS[2], entry)
+    redis.call('ZREM', KEYS[1], entry)
+end
+return #due
+"""
+
+
+def entry(task_id: str, result: Optional[dict], error: Optional[str] = None) -> str:
+    return json.dumps({"task_id": task_id, "result": result, "error": error, "attempts": 0, "created_at": time()})
+
+
+# Buffers results on a sync or asyncio pipeline, persisted once the pipeline executes
+def queue_entries(pipe, entries: List[str]):
+    if entries:
+        pipe.lpush(_PENDING, *entries)
+
+
+def push(conn: Redis, deliveries: List[Tuple[str, Optional[dict], Optional[str]]]):
+    if deliveries:
+        conn.lpush(_PENDING, *[entry(*delivery) for delivery in deliveries])
+
+
+def send_prompt_task_result(task_id, result, error = None):
+    print("Task id: ", task_id, flush=True)
+    print("Sending back: ", result, flush=True)
+    print("Error: ", error, flush=True)
+
+    result_url = env.MANAGER_API + env.SEND_PROMPT_RESULT_ROUTE
+    # Symfony backend onyl accepts formdata so we must send it like this
+    prompt_result = {"task_id": task_id, "prompt_result": result}
+    if error:
+        prompt_result["error"] = error
+    payload = {
+        "token": env.PROMPT_TOKEN,
+        "result_json": json.dumps(prompt_result)
+    }
+
+    res = http_client.post(result_url, read_timeout=http_client.MANAGER_READ_TIMEOUT, data=payload)
+    res.raise_for_status()
+
+    print("Server saving result responded: ", res.content, flush=True )
+
+
+def send_prompt_task_results(results: List[dict]):
+    payload = {
+        "token": env.PROMPT_TOKEN,
+        "results_json": json.dumps([
+            {"task_id": r["task_id"], "prompt_result": r["result"], **({"error": r["error"]} if r["error"] else {})}
+            for r in results
+        ])
+    }
+
+    res = http_client.post(env.MANAGER_API + BATCH_ROUTE, read_timeout=http_client.MANAGER_READ_TIMEOUT, data=payload)
+    res.raise_for_status()
+
+    print(f"Server saving {len(results)} results responded: ", res.content, flush=True)
+
+
+# Moves results from the pending list to this consumer's processing list, sends them and only
+# removes them once the manager accepted them. Anything left in processing after a crash is
+# picked up again on the next start.
+class OutboxDelivery:
+    def __init__(self, conn: Redis, consumer: Optional[str] = None):
+        self.conn = conn
+        self.processing = _PROCESSING_PREFIX + (consumer or socket.gethostname())
+        self._executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix="outbox")
+        self._promote = conn.register_script(_PROMOTE_SCRIPT)
+
+    def recover(self) -> int:
+        recovered = 0
+        while self.conn.lmove(self.processing, _PENDING, "LEFT", "RIGHT") is not None:
+            recovered += 1
+        if recovered:
+            print(f"[OUTBOX] Recovered {recovered} results from an interrupted run", flush=True)
+        return recovered
+
+    def run_once(self, block_seconds: float = 1) -> int:
+        self._promote(keys=[_RETRY, _PENDING], args=[time(), BATCH_SIZE])
+
+        first = self.conn.blmove(_PENDING, self.processing, block_seconds, "RIGHT", "LEFT")
+        if first is None:
+            self.__update_pending()
+            return 0
+
+        pipe = self.conn.pipeline(transaction=False)
+        for _ in range(BATCH_SIZE - 1):
+            pipe.lmove(_PENDING, self.processing, "RIGHT", "LEFT")
+        batch = [first] + [raw for raw in pipe.execute() if raw is not None]
+
+        self.__deliver(batch)
+        self.__update_pending()
+        return len(batch)
+
+    def __deliver(self, batch: List[bytes]):
+        entries = [json.loads(raw) for raw in batch]
+
+        deliverable = []
+        for raw, item in zip(batch, entries):
+            if item["error"] and not DELIVER_ERRORS:
+                self.__settle(raw, item, False, dead_reason="inference_failed")
+            else:
+                deliverable.append((raw, item))
+
+        if not deliverable:
+            return
+
+        if BATCH_ROUTE:
+            try:
+                send_prompt_task_results([item for _, item in deliverable])
+                outcomes = [True] * len(deliverable)
+            except Exception as e:
+                print(f"[OUTBOX] Batch delivery of {len(deliverable)} results failed: {e}", flush=True)
+                outcomes = [False] * len(deliverable)
+        else:
+            outcomes = list(self._executor.map(self.__send, [item for _, item in deliverable]))
+
+        for (raw, item), delivered in zip(deliverable, outcomes):
+            self.__settle(raw, item, delivered)
+
+    def __send(self, item: dict) -> bool:
+        try:
+            send_prompt_task_result(item["task_id"], item["result"], item["error"])
+            return True
+        except Exception as e:
+            print(f"[OUTBOX] Delivery of task {item['task_id']} failed (attempt {item['attempts'] + 1}): {e}", flush=True)
+            return False
+
+    def __settle(self, raw: bytes, item: dict, delivered: bool, dead_reason: Optional[str] = None):
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.lrem(self.processing, 1, raw)
+
+        if delivered:
+            outbox_delivered.inc()
+        else:
+            item["attempts"] += 1
+            if dead_reason is None and item["attempts"] >= MAX_ATTEMPTS:
+                dead_reason = "max_attempts"
+
+            if dead_reason is not None:
+                item["dead_reason"] = dead_reason
+                item["dead_at"] = time()
+                pipe.lpush(_DEAD, json.dumps(item))
+                pipe.ltrim(_DEAD, 0, DEAD_LETTER_MAX - 1)
+                outbox_dead_lettered.labels(dead_reason).inc()
+            else:
+                backoff = min(MIN_BACKOFF * 2 ** (item["attempts"] - 1), MAX_BACKOFF)
+                # Jitter so a backend outage does not end in one synchronized burst of retries
+                pipe.zadd(_RETRY, {json.dumps(item): time() + backoff * random.uniform(0.5, 1)})
+                outbox_retries.inc()
+
+        pipe.execute()
+
+    def __update_pending(self):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.llen(_PENDING)
+        pipe.zcard(_RETRY)
+        outbox_pending.set(sum(pipe.execute()))
+
+
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+
+if __name__ == '__main__':
+    start_http_server(METRICS_PORT)
+    while True:
+        try:
+            conn = Redis.from_url(redis_url, socket_timeout=None, retry_on_timeout=True)
+            delivery = OutboxDelivery(conn)
+            delivery.recover()
+            while True:
+                delivery.run_once()
+        except ConnectionError as e:
+            print(f"[OUTBOX] Redis unavailable, retrying in 2s... ({e})", flush=True)
+            sleep(2)
@@ -0,0 +1,98 @@
+import os
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+def _parse_weights(value: str) -> Dict[str, int]:
+    weights = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, weight = item.split("=")
+        weights[name.strip()] = max(1, int(weight))
+    return weights
+
+
+# Priority classes in order of precedence with their share of the workers while all of them have work
+PRIORITY_WEIGHTS = _parse_weights(os.getenv("PRIORITY_WEIGHTS", "interactive=6,default=3,bulk=1"))
+# Tenants share their class equally unless given a weight here, e.g. "catalog=1,shop=4"
+TENANT_WEIGHTS = _parse_weights(os.getenv("TENANT_WEIGHTS", ""))
+
+DEFAULT_PRIORITY = "default"
+DEFAULT_TENANT = "shared"
+TENANT_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+_QUEUE_PREFIX = "vision"
+# Queue the server used before priorities existed, still drained as the default class
+LEGACY_QUEUE = "default"
+
+
+def priority_rank(priority: str) -> int:
+    return list(PRIORITY_WEIGHTS).index(priority)
+
+
+def queue_name(priority: str, tenant: Optional[str]) -> str:
+    return f"{_QUEUE_PREFIX}.{priority}.{tenant or DEFAULT_TENANT}"
+
+
+# (priority, tenant) for queues of this server, None for anything else in Redis
+def parse_queue_name(name: str) -> Optional[Tuple[str, str]]:
+    if name == LEGACY_QUEUE:
+        return DEFAULT_PRIORITY, DEFAULT_TENANT
+
+    parts = name.split(".")
+    if len(parts) != 3 or parts[0] != _QUEUE_PREFIX or parts[1] not in PRIORITY_WEIGHTS:
+        return None
+    return parts[1], parts[2]
+
+
+# Smooth weighted round robin (as in nginx upstreams): over any window every active key is served in
+# proportion to its weight, interleaved instead of in bursts. Keys that go idle lose their credit so
+# a tenant cannot bank turns while it has nothing queued.
+class SmoothWeightedRoundRobin:
+    def __init__(self):
+        self.current = {}
+
+    def peek(self, weights: Dict[Hashable, int]) -> Hashable:
+        return max(weights, key=lambda key: (self.current.get(key, 0) + weights[key], weights[key]))
+
+    def commit(self, served: Hashable, weights: Dict[Hashable, int]):
+        self.current = {key: self.current.get(key, 0) + weight for key, weight in weights.items()}
+        self.current[served] = self.current.get(served, 0) - sum(weights.values())
+
+
+# Picks the queue a worker should pull from next: a priority class by PRIORITY_WEIGHTS, then a
+# tenant inside that class by TENANT_WEIGHTS. Only queues that currently hold jobs take part.
+class FairQueueOrder:
+    def __init__(self):
+        self.classes = SmoothWeightedRoundRobin()
+        self.tenants = {priority: SmoothWeightedRoundRobin() for priority in PRIORITY_WEIGHTS}
+        self._active = {}
+
+    # Queue names, best first. The rest stays in priority order as fallback for a lost race.
+    def order(self, depths: Dict[str, int]) -> List[str]:
+        self._active = {}
+        for name, depth in depths.items():
+            parsed = parse_queue_name(name)
+            if parsed is not None and depth > 0:
+                self._active.setdefault(parsed[0], {})[name] = TENANT_WEIGHTS.get(parsed[1], 1)
+
+        names = sorted(depths, key=lambda name: priority_rank(parse_queue_name(name)[0]))
+        if not self._active:
+            return names
+
+        priority = self.classes.peek({p: PRIORITY_WEIGHTS[p] for p in self._active})
+        first = self.tenants[priority].peek(self._active[priority])
+        return [first] + [name for name in names if name != first]
+
+    # Charges the turn to the queue the job actually came from
+    def served(self, name: str):
+        parsed = parse_queue_name(name)
+        if parsed is None:
+            return
+
+        priority = parsed[0]
+        active = self._active.setdefault(priority, {})
+        active.setdefault(name, TENANT_WEIGHTS.get(parsed[1], 1))
+
+        self.classes.commit(priority, {p: PRIORITY_WEIGHTS[p] for p in self._active})
+        self.tenants[priority].commit(name, active)
@@ -0,0 +1,239 @@
+import os
+import dns
+import random
+import ipaddress
+import requests
+import http_client
+from uuid import uuid4
+from urllib.parse import urlsplit, urlunsplit
+from time import time
+from redis import Redis
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+# Comma separated /infer urls, one per model server replica
+MODEL_SERVER_URLS = os.getenv("MODEL_SERVER_URLS", "")
+MODEL_SERVER_URL = os.getenv("MODEL_SERVER_URL", "")
+# Service name whose addresses are all replicas, e.g. a compose service scaled to several containers
+MODEL_SERVER_SERVICE = os.getenv("MODEL_SERVER_SERVICE", "")
+MODEL_SERVER_PORT = int(os.getenv("MODEL_SERVER_PORT", "8001"))
+
+EJECT_AFTER = int(os.getenv("REPLICA_EJECT_AFTER", "3"))
+EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+HEALTH_TIMEOUT = float(os.getenv("REPLICA_HEALTH_TIMEOUT", "2"))
+# A replica that looked unready stays at the back of the line this long unless a check finds it ready
+UNREADY_SECONDS = 30
+# Outstanding requests are leases, a work horse killed mid-request cannot leave a replica looking busy forever
+LEASE_SECONDS = http_client.CONNECT_TIMEOUT + http_client.MODEL_SERVER_READ_TIMEOUT + 10
+
+_EJECTED = "vision:replicas:ejected"
+_UNREADY = "vision:replicas:unready"
+_FAILURES = "vision:replicas:failures"
+_LEASES_PREFIX = "vision:replicas:leases:"
+
+# Least outstanding requests among the replicas with the best standing: excluded ('!' prefix, the
+# replica that just failed this job), unready and ejected replicas only get traffic when nothing
+# better is left. Callers shuffle the urls so ties are broken at random.
+_PICK_SCRIPT = """
+local now = tonumber(ARGV[1])
+local best, best_rank, best_load
+for i = 5, #ARGV do
+    local url = ARGV[i]
+    local rank = 0
+    if string.sub(url, 1, 1) == '!' then
+        url = string.sub(url, 2)
+        rank = 1
+    end
+    if tonumber(redis.call('ZSCORE', KEYS[2], url) or 0) > now then
+        rank = rank + 2
+    end
+    if tonumber(redis.call('ZSCORE', KEYS[1], url) or 0) > now then
+        rank = rank + 4
+    end
+    local leases = KEYS[3] .. url
+    redis.call('ZREMRANGEBYSCORE', leases, '-inf', now)
+    local load = redis.call('ZCARD', leases)
+    if not best or rank < best_rank or (rank == best_rank and load < best_load) then
+        best, best_rank, best_load = url, rank, load
+    end
+end
+if best then
+    redis.call('ZADD', KEYS[3] .. best, ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[3] .. best, ARGV[4])
+end
+return best
+"""
+
+# Counts consecutive failures, the replica is ejected for a while once there are enough of them
+_FAILURE_SCRIPT = """
+local failures = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+if failures >= tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+# A plain http url with a host name stands for every address of that name, the resolver keeps
+# the addresses current so a rescheduled container is picked up without restarting the workers
+def _expand(url: str) -> List[str]:
+    parts = urlsplit(url)
+    if parts.scheme != "http" or not parts.hostname:
+        return [url]
+    try:
+        ipaddress.ip_address(parts.hostname)
+        return [url]
+    except ValueError:
+        pass
+
+    try:
+        addresses = dns.resolve_all(parts.hostname)
+    except OSError as e:
+        print(f"[REPLICAS] Could not resolve {parts.hostname}:", e, flush=True)
+        return [url]
+    port = f":{parts.port}" if parts.port else ""
+    return [urlunsplit(parts._replace(netloc=f"{address}{port}")) for address in addresses]
+
+
+def configured_urls() -> List[str]:
+    if MODEL_SERVER_URLS:
+        urls = [url.strip() for url in MODEL_SERVER_URLS.split(",") if url.strip()]
+    elif MODEL_SERVER_URL:
+        urls = [MODEL_SERVER_URL]
+    elif MODEL_SERVER_SERVICE:
+        urls = [f"http://{MODEL_SERVER_SERVICE}:{MODEL_SERVER_PORT}/infer"]
+    else:
+        urls = [f"http://localhost:{MODEL_SERVER_PORT}/infer"]
+    return list(dict.fromkeys(address_url for url in urls for address_url in _expand(url)))
+
+
+def capacity_url(url: str) -> str:
+    return url.rsplit("/", 1)[0] + "/capacity"
+
+
+# Connection errors, timeouts and 5xx count against a replica, a 503 is a busy or loading one. Anything
+# else, e.g. a body that is not the expected JSON, says nothing about the health of the replica.
+def is_replica_failure(e: BaseException) -> bool:
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 and e.response.status_code != 503
+    return False
+
+
+# Routes inference calls over the model server replicas. The state lives in Redis because every job
+# runs in a freshly forked work horse, and so every worker sees the same outstanding requests.
+class ReplicaPool:
+    def __init__(self, conn: Redis, urls: Callable[[], List[str]] = configured_urls):
+        self.conn = conn
+        self.urls = urls
+        self._pick = conn.register_script(_PICK_SCRIPT)
+        self._failure = conn.register_script(_FAILURE_SCRIPT)
+        self._executor = None
+        # Threads of the parent do not exist in a forked work horse
+        os.register_at_fork(after_in_child=self.__drop_executor)
+
+    def __drop_executor(self):
+        self._executor = None
+
+    @contextmanager
+    def lease(self, exclude: Iterable[Optional[str]] = ()):
+        excluded = set(exclude)
+        urls = self.urls()
+        random.shuffle(urls)
+        lease_id = str(uuid4())
+        now = time()
+
+        url = self._pick(
+            keys=[_EJECTED, _UNREADY, _LEASES_PREFIX],
+            args=[now, now + LEASE_SECONDS, lease_id, int(LEASE_SECONDS)] + [("!" + u if u in excluded else u) for u in urls],
+        )
+        if url is None:
+            raise RuntimeError("No model server replicas configured")
+
+        url = url.decode() if isinstance(url, bytes) else url
+        try:
+            yield url
+        finally:
+            self.conn.zrem(_LEASES_PREFIX + url, lease_id)
+
+    def report(self, url: str, ok: bool):
+        if ok:
+            self.conn.hdel(_FAILURES, url)
+        elif self._failure(keys=[_FAILURES, _EJECTED], args=[url, EJECT_AFTER, time() + EJECT_SECONDS]):
+            print(f"[REPLICAS] Ejected {url} for {EJECT_SECONDS:.0f}s after {EJECT_AFTER} failures", flush=True)
+
+    def __probe(self, url: str) -> Optional[dict]:
+        try:
+            res = http_client.get(capacity_url(url), read_timeout=HEALTH_TIMEOUT)
+            if res.status_code == 404:
+                return {}
+            res.raise_for_status()
+            return res.json()
+        except Exception as e:
+            print(f"[REPLICAS] Health check of {url} failed:", e, flush=True)
+            return None
+
+    # Active health check of every replica, returns their combined capacity in the format of a single
+    # model server's /capacity, or None when no replica could be reached
+    def check(self) -> Optional[dict]:
+        urls = self.urls()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="replica-check")
+        probes = list(self._executor.map(self.__probe, urls))
+
+        now = time()
+        pipe = self.conn.pipeline(transaction=False)
+        for url, capacity in zip(urls, probes):
+            if capacity is not None and capacity.get("status", "ready") == "ready":
+                pipe.zrem(_UNREADY, url)
+            else:
+                pipe.zadd(_UNREADY, {url: now + UNREADY_SECONDS})
+        pipe.zrangebyscore(_EJECTED, now, "+inf")
+        ejected = {u.decode() for u in pipe.execute()[-1]}
+
+        for url, capacity in zip(urls, probes):
+            if capacity is None:
+                self.report(url, False)
+
+        reachable = [capacity for url, capacity in zip(urls, probes) if capacity is not None and url not in ejected]
+        if not reachable:
+            return None
+
+        ready = [capacity for capacity in reachable if capacity.get("status", "ready") == "ready"]
+        if not ready:
+            return {"status": reachable[0]["status"], "slots": sum(c.get("slots", 0) for c in reachable), "busy": 0, "queued": 0, "saturated": True}
+
+        return {
+            "status": "ready",
+            "replicas": len(ready),
+            "slots": sum(c.get("slots", 0) for c in ready),
+            "busy": sum(c.get("busy", 0) for c in ready),
+            "queued": sum(c.get("queued", 0) for c in ready),
+            "saturated": all(c.get("saturated", False) for c in ready),
+        }
+
+    def snapshot(self) -> dict:
+        urls = self.urls()
+        now = time()
+        pipe = self.conn.pipeline(transaction=False)
+        for url in urls:
+            pipe.zcount(_LEASES_PREFIX + url, now, "+inf")
+            pipe.hget(_FAILURES, url)
+            pipe.zscore(_EJECTED, url)
+            pipe.zscore(_UNREADY, url)
+        replies = pipe.execute()
+
+        replicas = {}
+        for i, url in enumerate(urls):
+            outstanding, failures, ejected_until, unready_until = replies[i * 4:i * 4 + 4]
+            replicas[url] = {
+                "outstanding": outstanding,
+                "failures": int(failures or 0),
+                "ejected": bool(ejected_until and ejected_until > now),
+                "ready": not (unready_until and unready_until > now),
+            }
+        return replicas
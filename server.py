@@ -1,18 +1,22 @@
 import os
 import env 
-import dns
-import json
-import socket 
-import requests
 import traceback
-from rq import Queue
+import task_cache
+import http_client
+import async_queue
+import outbox
+from replicas import ReplicaPool, is_replica_failure
+from priority import PRIORITY_WEIGHTS, DEFAULT_PRIORITY, TENANT_PATTERN, queue_name, parse_queue_name, priority_rank
+from uuid import uuid4
+from rq import Queue, Callback
+from rq.timeouts import JobTimeoutException
 from time import sleep 
 from redis import Redis
-from fastapi import FastAPI
-from pydantic import BaseModel
-from jsonz.validator import is_valid_json
-from typing import List, Optional, Any, Dict, Union 
-from jsonz.extractor import extract_json_from_str
+from redis.asyncio import Redis as AsyncRedis
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel, Field, field_validator
+from jsonz.validator import compile_schema
+from typing import List, Optional, Dict, Union 
 from prometheus_fastapi_instrumentator  import Instrumentator
 from prometheus_client import Counter, Histogram, Gauge
 
@@ -24,12 +28,22 @@ app = FastAPI()
 # Connect prometheus to track FastAPI app and establish a /metrics endpoint
 Instrumentator().instrument(app).expose(app)
 queue_size_gauge = Gauge("queue_size_gauge", "Current size of the inference job queue")
+queue_depth_by_priority = Gauge("queue_depth_by_priority", "Queued inference jobs per priority class, all tenants", ["priority"])
 visual_inference_duration_in_seconds = Histogram("visual_inference_duration_in_seconds", "Duration of vision inference jobs in seconds")
 visual_inference_failure_count = Counter("visual_inference_failure_count", "Total number of inference jobs failed")
 
-# Establish redis connection and access the queue 
+# Establish redis connection, every priority class and tenant gets its own queue
 redis_conn = Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), socket_timeout=None, retry_on_timeout=True)
-queue = Queue(connection=redis_conn)
+queues: Dict[str, Queue] = {}
+
+# Ingestion runs on the event loop, workers and result delivery keep the sync client
+redis_async = AsyncRedis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), socket_timeout=None, retry_on_timeout=True)
+submit_script = redis_async.register_script(task_cache.SUBMIT_SCRIPT)
+
+BULK_MAX_TASKS = int(os.getenv("BULK_MAX_TASKS", "5000"))
+
+# Model server replicas, shared by the app, the workers and their work horses through Redis
+model_servers = ReplicaPool(redis_conn)
 
 class VisionTaskRequest(BaseModel):
     images: List[str]
@@ -38,62 +52,183 @@ class VisionTaskRequest(BaseModel):
     system_prompt: Union[str, None]
     prompt: str 
     expected_json_schema: Optional[Dict[str, str]] = None 
+    priority: str = DEFAULT_PRIORITY
+    # Callers sharing a priority class get equal turns per tenant
+    tenant: Optional[str] = Field(default=None, pattern=TENANT_PATTERN)
+    # Caps the image slices the model server encodes, fewer slices trade detail for speed
+    max_slices: Optional[int] = Field(default=None, ge=0)
+
+    @field_validator("priority")
+    @classmethod
+    def check_priority(cls, priority):
+        if priority not in PRIORITY_WEIGHTS:
+            raise ValueError(f"unknown priority {priority!r}, expected one of {', '.join(PRIORITY_WEIGHTS)}")
+        return priority
+
+    # Malformed schemas are rejected at ingestion instead of occupying a worker and the model
+    @field_validator("expected_json_schema")
+    @classmethod
+    def check_schema(cls, schema):
+        if schema:
+            compile_schema(schema)
+        return schema
 
 @app.post("/inference/new_vision_task")
-def new_vision_task(task: VisionTaskRequest):
+async def new_vision_task(task: VisionTaskRequest):
     if task.token != env.SERVER_TOKEN: 
         print("Invalid access token")
         return {"status": "denied"}
 
-    print(f"Submitting new task: {task.task_id}", flush=True)
-    job = queue.enqueue(run_vision_inference, task.prompt, task.system_prompt, task.images, task.task_id, task.expected_json_schema, job_timeout=600)
+    return (await _submit_tasks([task]))[0]
+
+# Catalog refreshes from the manager, the whole list costs two Redis round trips
+@app.post("/inference/new_vision_tasks")
+async def new_vision_tasks(tasks: List[VisionTaskRequest]):
+    if len(tasks) > BULK_MAX_TASKS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_TASKS} tasks per request")
+
+    accepted = [task for task in tasks if task.token == env.SERVER_TOKEN]
+    if len(accepted) < len(tasks):
+        print(f"Invalid access token on {len(tasks) - len(accepted)} bulk tasks")
+
+    submitted = iter(await _submit_tasks(accepted))
+    results = [next(submitted) if task.token == env.SERVER_TOKEN else {"status": "denied", "task_id": task.task_id} for task in tasks]
+    return {"tasks": results}
+
+async def _submit_tasks(tasks: List[VisionTaskRequest]) -> List[dict]:
+    if not tasks:
+        return []
+
+    cache_keys = [task_cache.task_key(task.prompt, task.system_prompt, task.images, task.expected_json_schema, task.max_slices) for task in tasks]
+    job_ids = [str(uuid4()) for _ in tasks]
+
+    # Round trip 1: result cache lookup, claim or attach to a running duplicate, one script call per task
+    pipe = redis_async.pipeline(transaction=False)
+    for task, cache_key, job_id in zip(tasks, cache_keys, job_ids):
+        await submit_script(keys=task_cache.submit_keys(cache_key), args=task_cache.submit_args(job_id, task.task_id, priority_rank(task.priority)), client=pipe)
+    replies = await pipe.execute()
+
+    responses = []
+    claimed = []
+    deliveries = []
+    for task, cache_key, job_id, reply in zip(tasks, cache_keys, job_ids, replies):
+        status, value = task_cache.parse_submit(reply)
+        if status == task_cache.SUBMIT_CACHED:
+            print(f"Answering task {task.task_id} from result cache", flush=True)
+            deliveries.append(outbox.entry(task.task_id, value))
+            responses.append({"status": "queued", "task_id": task.task_id, "job_id": None, "deduplicated": "result_cache"})
+        elif status == task_cache.SUBMIT_ATTACHED:
+            print(f"Attached task {task.task_id} to running job {value}", flush=True)
+            responses.append({"status": "queued", "task_id": task.task_id, "job_id": value, "deduplicated": "in_flight"})
+        else:
+            claimed.append((task, cache_key, job_id))
+            responses.append({"status": "queued", "task_id": task.task_id, "job_id": job_id})
+
+    if not claimed and not deliveries:
+        return responses
 
-    queue_size_gauge.set(queue.count)  # update gauge here when job is queued
+    # Round trip 2: cached results for the outbox, every new job and the queue depths for the gauges in one transaction
+    pipe = redis_async.pipeline(transaction=True)
+    outbox.queue_entries(pipe, deliveries)
+    for task, cache_key, job_id in claimed:
+        print(f"Submitting new task: {task.task_id} ({task.priority}, tenant {task.tenant})", flush=True)
+        queue = _get_queue(task.priority, task.tenant)
+        job = queue.create_job(
+            run_vision_inference,
+            args=(task.prompt, task.system_prompt, task.images, task.task_id, task.expected_json_schema, cache_key, task.max_slices),
+            job_id=job_id,
+            timeout=600,
+            on_failure=Callback(release_failed_job),
+        )
+        async_queue.push_job(pipe, queue, job)
+    if claimed:
+        pipe.eval(*async_queue.queue_depths_args())
 
-    return {"status": "queued", "task_id": task.task_id, "job_id": job.id}
+    try:
+        replies = await pipe.execute()
+    except Exception:
+        # Release the claims, otherwise duplicates would attach to jobs that were never queued
+        release = redis_async.pipeline(transaction=False)
+        for _, cache_key, _ in claimed:
+            task_cache.queue_finish(release, cache_key, None)
+        await release.execute()
+        raise
+
+    if claimed:
+        _update_queue_gauges(async_queue.parse_queue_depths(replies[-1]))  # update gauges here when jobs are queued
+
+    return responses
+
+def _get_queue(priority: str, tenant: Optional[str]) -> Queue:
+    name = queue_name(priority, tenant)
+    if name not in queues:
+        queues[name] = Queue(name, connection=redis_conn)
+    return queues[name]
+
+# Depth per priority class and tenant, {priority: {"depth": n, "tenants": {tenant: n}}}
+def _update_queue_gauges(depths: Dict[str, int]) -> dict:
+    by_priority = {priority: {"depth": 0, "tenants": {}} for priority in PRIORITY_WEIGHTS}
+    for name, depth in depths.items():
+        parsed = parse_queue_name(name)
+        if parsed is None:
+            continue
+        priority, tenant = parsed
+        by_priority[priority]["depth"] += depth
+        by_priority[priority]["tenants"][tenant] = by_priority[priority]["tenants"].get(tenant, 0) + depth
+
+    for priority, stats in by_priority.items():
+        queue_depth_by_priority.labels(priority).set(stats["depth"])
+    queue_size_gauge.set(sum(stats["depth"] for stats in by_priority.values()))
+    return by_priority
+
+@app.get("/inference/queues")
+async def get_queue_depths():
+    return _update_queue_gauges(async_queue.parse_queue_depths(await redis_async.eval(*async_queue.queue_depths_args())))
+
+@app.get("/inference/replicas")
+def get_replicas():
+    return model_servers.snapshot()
 
 @app.get("/ping")
 def ping():
     return {"ping": "pong"}
 
 
-_model_server_ip = None 
-def _get_model_server_url() -> str: 
-    env_url = os.getenv("MODEL_SERVER_URL")
-    if env_url:
-        return env_url
-
-    global _model_server_ip
-    if _model_server_ip is None:
-        _model_server_ip = dns.resolve('model-server')
-
-    return f"http://localhost:8001/infer"
+# Combined capacity of the model server replicas, None when none of them could be asked
+def get_model_server_capacity() -> Optional[dict]:
+    return model_servers.check()
 
 
-def run_vision_inference(prompt, system_prompt, images, task_id, expected_json_schema):
+def run_vision_inference(prompt, system_prompt, images, task_id, expected_json_schema, cache_key=None, max_slices=None):
     print("Running vision inference for request id:", task_id, flush=True)
-    # Ping local IP instead of spamming docker DNS 
-    model_server_url = _get_model_server_url()
 
     inference_attempts = 3
     json_result = None
+    failed_replica = None
     try:
         while inference_attempts > 0:
             response = None
-            with visual_inference_duration_in_seconds.time():
+            # Least loaded replica, a retry goes elsewhere if there is anywhere else to go
+            with visual_inference_duration_in_seconds.time(), model_servers.lease(exclude=[failed_replica]) as model_server_url:
                 try:
-                    session = requests.Session()
-
-                    res = session.post(
+                    res = http_client.post(
                         model_server_url,
-                        json={"prompt": prompt, "images": images, "system_prompt": system_prompt, "expected_json_schema": expected_json_schema},
-                        timeout=600,
+                        read_timeout=http_client.MODEL_SERVER_READ_TIMEOUT,
+                        json={"prompt": prompt, "images": images, "system_prompt": system_prompt, "expected_json_schema": expected_json_schema, "max_slices": max_slices},
                     )
                     res.raise_for_status()
                     response = res.json().get("result")
+                    model_servers.report(model_server_url, True)
+                    failed_replica = None
+                except JobTimeoutException:
+                    # The job is out of time, not the replica, retrying would only run into the next alarm
+                    raise
                 except Exception as e:
-                    print("Model server request failed:", e, flush=True)
+                    print(f"Model server request to {model_server_url} failed:", e, flush=True)
                     print("Stack: ", traceback.format_exc(), flush=True)
+                    if is_replica_failure(e):
+                        model_servers.report(model_server_url, False)
+                    failed_replica = model_server_url
                     response = None
                 print("Completed with response:", response, flush=True)
 
@@ -110,41 +245,38 @@ def run_vision_inference(prompt, system_prompt, images, task_id, expected_json_s
         if json_result is None:
             visual_inference_failure_count.inc()
             print(f"Inference failed for request: {task_id}", flush=True)
-            send_prompt_task_result(task_id, None, f"Inference failed for request: {task_id}")
+            _deliver_result(task_id, cache_key, None, f"Inference failed for request: {task_id}")
             return {"success": False, "reason": f"Inference failed for request: {task_id}"}
 
         print("Extracted:", json_result, flush=True)
-        send_prompt_task_result(task_id, json_result)
+        _deliver_result(task_id, cache_key, json_result)
         return {"success": True, "result": json_result}
 
+    except JobTimeoutException:
+        raise
     except Exception as e:
         visual_inference_failure_count.inc()
         print("Inference failed:", e, flush=True)
-        send_prompt_task_result(task_id, json_result, f"Inference failed for request: {task_id}")
+        _deliver_result(task_id, cache_key, None, f"Inference failed for request: {task_id}")
         return {"success": False, "reason": "Inference failed"}
-    
-
-def send_prompt_task_result(task_id, result, error = None):
-    # For now 
-    if error: 
-        return 
-    
-    print("Task id: ", task_id, flush=True)
-    print("Sending back: ", result, flush=True)
-    print("Error: ", error, flush=True)
-
-    result_url = env.MANAGER_API + env.SEND_PROMPT_RESULT_ROUTE
-    # Symfony backend onyl accepts formdata so we must send it like this
-    payload = {
-        "token": env.PROMPT_TOKEN,
-        "result_json": json.dumps({
-            "task_id": task_id,
-            "prompt_result": result
-        })
-    }
 
-    res = requests.post(result_url, data=payload)
 
-    print("Server saving result responded: ", res.content, flush=True )
+# The job died: timed out, or abandoned by a worker that was killed. If it had not delivered yet its task
+# and the duplicates attached to it get the failure instead of waiting on a dead job until INFLIGHT_TTL.
+# A job that already delivered, or whose entry a duplicate took over, leaves the outbox alone.
+def release_failed_job(job, connection, *exc_info):
+    task_id, cache_key = job.args[3], job.args[5]
+    if not cache_key:
+        return
+    released, waiters = task_cache.release(redis_conn, cache_key, job.id)
+    if not released:
+        return
+    print(f"Job {job.id} for request {task_id} died, releasing {len(waiters)} attached tasks", flush=True)
+    outbox.push(redis_conn, [(waiting_task_id, None, f"Inference failed for request: {task_id}") for waiting_task_id in [task_id] + waiters])
 
 
+# Hands the result for the submitting task and every duplicate that attached to its job to the outbox,
+# the worker is free again as soon as it is persisted
+def _deliver_result(task_id, cache_key, result, error = None):
+    waiters = task_cache.finish(redis_conn, cache_key, result) if cache_key else []
+    outbox.push(redis_conn, [(waiting_task_id, result, error) for waiting_task_id in [task_id] + waiters])
@@ -0,0 +1,204 @@
+import os
+import sys
+import signal
+import subprocess
+from time import sleep, time, monotonic
+from rq.job import Job
+from rq.queue import Queue
+from rq.utils import utcparse
+from redis import Redis
+from redis.exceptions import ConnectionError
+from typing import List, Optional
+from prometheus_client import Counter, Gauge, start_http_server
+from priority import parse_queue_name
+from replicas import ReplicaPool
+
+WORKERS_MIN = int(os.getenv("WORKERS_MIN", "1"))
+WORKERS_MAX = int(os.getenv("WORKERS_MAX", "4"))
+INTERVAL = float(os.getenv("SUPERVISOR_INTERVAL", "5"))
+# Queued jobs a single worker is expected to keep up with, a longer queue adds a worker
+JOBS_PER_WORKER = int(os.getenv("SUPERVISOR_JOBS_PER_WORKER", "4"))
+# A job waiting longer than this adds a worker even while the queue is short
+MAX_JOB_AGE = float(os.getenv("SUPERVISOR_MAX_JOB_AGE", "30"))
+# Workers are retired one per interval once every queue has been empty this long
+IDLE_SECONDS = float(os.getenv("SUPERVISOR_IDLE_SECONDS", "60"))
+METRICS_PORT = int(os.getenv("SUPERVISOR_METRICS_PORT", "8003"))
+# A retired worker finishes its job first, after this long it is killed
+RETIRE_TIMEOUT = float(os.getenv("SUPERVISOR_RETIRE_TIMEOUT", "600"))
+
+queued_jobs = Gauge("queued_jobs", "Inference jobs waiting in all queues, sampled by the worker supervisor")
+oldest_queued_job_age_seconds = Gauge("oldest_queued_job_age_seconds", "Age of the longest waiting inference job")
+model_free_slots = Gauge("model_free_slots", "Free model server slots over all ready replicas")
+workers_running = Gauge("workers_running", "Worker processes taking jobs")
+workers_retiring = Gauge("workers_retiring", "Worker processes finishing their last job before exiting")
+worker_scale_events = Counter("worker_scale_events", "Worker processes started or retired by the supervisor", ["direction"])
+worker_job_overhead_seconds = Gauge("worker_job_overhead_seconds", "Average time per job spent on forking and reaping work horses, or its remainder without fork", ["mode"])
+
+# Per-job overhead totals of all workers by execution mode, written by worker.py
+_OVERHEAD = "vision:workers:overhead"
+
+# Flat [queue key, length, enqueued_at of the job at the head, ...], RQ pops from the left so the
+# head is the oldest job. enqueued_at is '' for an empty queue.
+_OLDEST_SCRIPT = """
+local reply = {}
+for _, key in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local depth = redis.call('LLEN', key)
+    local enqueued_at = ''
+    if depth > 0 then
+        local job_id = redis.call('LINDEX', key, 0)
+        enqueued_at = redis.call('HGET', ARGV[1] .. job_id, 'enqueued_at') or ''
+    end
+    reply[#reply + 1] = key
+    reply[#reply + 1] = depth
+    reply[#reply + 1] = enqueued_at
+end
+return reply
+"""
+
+
+# One worker more or less per interval. Workers are only added while the model servers have room,
+# a worker beyond their capacity would only back off.
+def desired_workers(running: int, depth: int, oldest_age: float, capacity: Optional[dict], idle_for: float) -> int:
+    running = min(max(running, WORKERS_MIN), WORKERS_MAX)
+    has_room = capacity is not None and capacity.get("status", "ready") == "ready" and not capacity.get("saturated")
+    if depth and has_room and (depth > running * JOBS_PER_WORKER or oldest_age > MAX_JOB_AGE):
+        return min(running + 1, WORKERS_MAX)
+    if not depth and idle_for >= IDLE_SECONDS:
+        return max(running - 1, WORKERS_MIN)
+    return running
+
+
+class WorkerSupervisor:
+    def __init__(self, conn: Redis, command: List[str]):
+        self.conn = conn
+        self.command = command
+        self.workers: List[subprocess.Popen] = []
+        self.retiring: List[subprocess.Popen] = []
+        # Workers that exit on their own, e.g. after passing WORKER_MAX_RSS_MB, are replaced
+        self.target = WORKERS_MIN
+        self.replicas = ReplicaPool(conn)
+        self._oldest = conn.register_script(_OLDEST_SCRIPT)
+        self._idle_since = monotonic()
+        self._overhead_totals = {}
+
+    def sample(self) -> dict:
+        reply = self._oldest(keys=[Queue.redis_queues_keys], args=[Job.redis_job_namespace_prefix])
+        depth, oldest = 0, None
+        for key, length, enqueued_at in zip(reply[::3], reply[1::3], reply[2::3]):
+            name = key.decode()[len(Queue.redis_queue_namespace_prefix):]
+            if parse_queue_name(name) is None:
+                continue
+            depth += int(length)
+            if enqueued_at:
+                enqueued = utcparse(enqueued_at.decode()).timestamp()
+                oldest = enqueued if oldest is None else min(oldest, enqueued)
+
+        capacity = self.replicas.check()
+        free = 0
+        if capacity is not None and capacity.get("status", "ready") == "ready":
+            free = max(0, capacity.get("slots", 0) - capacity.get("busy", 0))
+
+        oldest_age = max(0.0, time() - oldest) if oldest is not None else 0.0
+        queued_jobs.set(depth)
+        oldest_queued_job_age_seconds.set(oldest_age)
+        model_free_slots.set(free)
+        self.__sample_overhead()
+        return {"depth": depth, "oldest_age": oldest_age, "capacity": capacity}
+
+    # Average over the jobs since the previous sample
+    def __sample_overhead(self):
+        totals = {key.decode(): float(value) for key, value in self.conn.hgetall(_OVERHEAD).items()}
+        for mode in {key.split(":")[0] for key in totals}:
+            seconds, jobs = totals.get(f"{mode}:seconds", 0.0), totals.get(f"{mode}:jobs", 0.0)
+            last_seconds, last_jobs = self._overhead_totals.get(mode, (0.0, 0.0))
+            if jobs > last_jobs:
+                worker_job_overhead_seconds.labels(mode).set((seconds - last_seconds) / (jobs - last_jobs))
+            self._overhead_totals[mode] = (seconds, jobs)
+
+    def __reap(self):
+        for process in self.workers:
+            if process.poll() is not None:
+                print(f"[SUPERVISOR] Worker {process.pid} exited with {process.returncode}", flush=True)
+        self.workers = [process for process in self.workers if process.returncode is None]
+
+        for process in self.retiring:
+            if process.poll() is None and monotonic() - process.retired_at > RETIRE_TIMEOUT:
+                print(f"[SUPERVISOR] Worker {process.pid} did not finish in {RETIRE_TIMEOUT:.0f}s, killing it", flush=True)
+                process.kill()
+        self.retiring = [process for process in self.retiring if process.poll() is None]
+
+    def __spawn(self):
+        process = subprocess.Popen(self.command)
+        self.workers.append(process)
+        worker_scale_events.labels("up").inc()
+        print(f"[SUPERVISOR] Started worker {process.pid}, {len(self.workers)} running", flush=True)
+
+    # SIGTERM is a warm shutdown in RQ, the worker finishes its current job and exits
+    def __retire(self):
+        process = self.workers.pop()
+        process.send_signal(signal.SIGTERM)
+        process.retired_at = monotonic()
+        self.retiring.append(process)
+        worker_scale_events.labels("down").inc()
+        print(f"[SUPERVISOR] Retiring worker {process.pid}, {len(self.workers)} running", flush=True)
+
+    def run_once(self):
+        self.__reap()
+        sample = self.sample()
+        if sample["depth"]:
+            self._idle_since = monotonic()
+
+        desired = desired_workers(self.target, sample["depth"], sample["oldest_age"], sample["capacity"], monotonic() - self._idle_since)
+        if desired != self.target:
+            print(f"[SUPERVISOR] {sample['depth']} queued, oldest {sample['oldest_age']:.1f}s, scaling to {desired} workers", flush=True)
+        self.target = desired
+        while len(self.workers) < desired:
+            self.__spawn()
+        while len(self.workers) > desired:
+            self.__retire()
+            # Retiring one worker per interval is enough, an idle period just started again
+            self._idle_since = monotonic()
+
+        workers_running.set(len(self.workers))
+        workers_retiring.set(len(self.retiring))
+
+    def stop(self):
+        for process in self.workers + self.retiring:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self.workers + self.retiring:
+            try:
+                process.wait(timeout=RETIRE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+stopping = False
+
+
+def _request_stop(signum, frame):
+    global stopping
+    stopping = True
+
+
+if __name__ == '__main__':
+    start_http_server(METRICS_PORT)
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    conn = Redis.from_url(redis_url, socket_timeout=None, retry_on_timeout=True)
+    supervisor = WorkerSupervisor(conn, [sys.executable, "-m", "worker"])
+    while not stopping:
+        try:
+            supervisor.run_once()
+        except ConnectionError as e:
+            # Workers keep running and reconnect on their own
+            print(f"[SUPERVISOR] Redis unavailable, retrying... ({e})", flush=True)
+
+        deadline = monotonic() + INTERVAL
+        while not stopping and monotonic() < deadline:
+            sleep(0.2)
+
+    print("[SUPERVISOR] Stopping workers", flush=True)
+    supervisor.stop()
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+from redis import Redis
+from typing import Any, List, Optional, Tuple
+
+RESULT_TTL = int(os.getenv("RESULT_CACHE_TTL", "3600"))
+# Upper bound for queue wait + job runtime, after that a duplicate starts its own job
+INFLIGHT_TTL = int(os.getenv("INFLIGHT_TTL", "7200"))
+
+_RESULT_PREFIX = "vision:result:"
+_INFLIGHT_PREFIX = "vision:inflight:"
+_WAITERS_PREFIX = "vision:waiters:"
+
+SUBMIT_CACHED = "cached"
+SUBMIT_CLAIMED = "claimed"
+SUBMIT_ATTACHED = "attached"
+
+# Result lookup, claim and attach run as one script so a submission is a single round trip that can
+# be pipelined. Attaching has to be atomic with finish(), otherwise a waiter could be pushed after
+# the waiter list was drained and never get a result.
+# The in-flight entry is "<priority rank>:<job id>". A duplicate only attaches to a job of the same or
+# a more urgent class, otherwise it queues its own job and takes over the entry; whichever job
+# finishes first answers every waiter.
+SUBMIT_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+if cached then
+    return {'cached', cached}
+end
+local current = redis.call('GET', KEYS[2])
+if current then
+    local sep = string.find(current, ':', 1, true)
+    if not sep or tonumber(string.sub(current, 1, sep - 1)) <= tonumber(ARGV[4]) then
+        redis.call('RPUSH', KEYS[3], ARGV[3])
+        redis.call('EXPIRE', KEYS[3], ARGV[2])
+        return {'attached', sep and string.sub(current, sep + 1) or current}
+    end
+end
+redis.call('SET', KEYS[2], ARGV[4] .. ':' .. ARGV[1], 'EX', ARGV[2])
+return {'claimed', ARGV[1]}
+"""
+
+# Drops the in-flight entry of a job that died without finishing, {1, waiters} or {0} when the entry
+# is not that job's: it already finished, or a more urgent duplicate took it over and answers the waiters.
+RELEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current or string.sub(current, -#ARGV[1] - 1) ~= ':' .. ARGV[1] then
+    return {0}
+end
+redis.call('DEL', KEYS[1])
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return {1, waiters}
+"""
+
+
+def task_key(prompt: str, system_prompt: Optional[str], images: List[str], expected_json_schema: Optional[dict], max_slices: Optional[int] = None) -> str:
+    fields = {"prompt": prompt, "system_prompt": system_prompt, "images": images, "expected_json_schema": expected_json_schema}
+    # Only part of the key when set, results cached before the field existed keep their keys
+    if max_slices is not None:
+        fields["max_slices"] = max_slices
+    canonical = json.dumps(
+        fields,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def submit_keys(key: str) -> List[str]:
+    return [_RESULT_PREFIX + key, _INFLIGHT_PREFIX + key, _WAITERS_PREFIX + key]
+
+
+# priority_rank is 0 for the most urgent class
+def submit_args(job_id: str, task_id: str, priority_rank: int) -> list:
+    return [job_id, INFLIGHT_TTL, task_id, priority_rank]
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# (SUBMIT_CACHED, result), (SUBMIT_CLAIMED, job id the caller has to enqueue) or (SUBMIT_ATTACHED, running job id)
+def parse_submit(reply: list) -> Tuple[str, Any]:
+    status, value = _decode(reply[0]), reply[1]
+    if status == SUBMIT_CACHED:
+        return status, json.loads(value)
+    return status, _decode(value)
+
+
+# Buffers finish() on a sync or asyncio pipeline, the last reply is the list of attached task ids
+def queue_finish(pipe, key: str, result: Optional[dict]):
+    if result is not None:
+        pipe.set(_RESULT_PREFIX + key, json.dumps(result), ex=RESULT_TTL)
+    pipe.delete(_INFLIGHT_PREFIX + key)
+    pipe.lrange(_WAITERS_PREFIX + key, 0, -1)
+    pipe.delete(_WAITERS_PREFIX + key)
+
+
+# Stores a successful result and returns the task ids that attached to the job
+def finish(conn: Redis, key: str, result: Optional[dict]) -> List[str]:
+    pipe = conn.pipeline(transaction=True)
+    queue_finish(pipe, key, result)
+    waiters = pipe.execute()[-2]
+    return [_decode(w) for w in waiters]
+
+
+# For a job that ended without finish(): whether its entry was still in flight, and the task ids that attached to it
+def release(conn: Redis, key: str, job_id: str) -> Tuple[bool, List[str]]:
+    reply = conn.eval(RELEASE_SCRIPT, 2, _INFLIGHT_PREFIX + key, _WAITERS_PREFIX + key, job_id)
+    if not reply[0]:
+        return False, []
+    return True, [_decode(w) for w in reply[1]]
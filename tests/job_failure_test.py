@@ -0,0 +1,139 @@
+# Jobs that die without delivering: the real server.py submit path and worker.py against a stand-in model
+# server that never answers. A killed work horse, a job timeout and the memory limit of a worker without
+# fork all have to end the job. The submitting task and its attached duplicate get the failure, and a job
+# that already delivered must not send one.
+#
+#   python tests/job_failure_test.py --redis-url redis://localhost:6379/15
+#
+# The Redis database given by --redis-url is flushed before every case, point it at a scratch database.
+
+import os
+import sys
+import json
+import signal
+import asyncio
+import argparse
+import tempfile
+import threading
+
+from rq.job import Job
+from fastapi import FastAPI
+from load_test import REPO_DIR, TOKEN, free_port, serve_in_thread, write_env
+
+arrived = threading.Event()
+# The asyncio Redis client of server.py stays bound to the loop of its first command
+loop = asyncio.new_event_loop()
+
+
+def hanging_model_server() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/capacity")
+    async def capacity():
+        return {"slots": 4, "busy": 0, "queued": 0, "saturated": False}
+
+    @app.post("/infer")
+    async def infer():
+        arrived.set()
+        await asyncio.sleep(3600)
+
+    return app
+
+
+def submit(server, conn, key_prompt: str) -> dict:
+    conn.flushdb()
+    arrived.clear()
+    tasks = [
+        server.VisionTaskRequest(images=[], token=TOKEN, task_id=f"{key_prompt}-{i}", system_prompt=None, prompt=key_prompt)
+        for i in range(2)
+    ]
+    first, duplicate = loop.run_until_complete(server._submit_tasks(tasks))
+    assert duplicate.get("deduplicated") == "in_flight", duplicate
+    return first
+
+
+def outbox_entries(conn) -> dict:
+    return {entry["task_id"]: entry for entry in map(json.loads, conn.lrange("vision:outbox", 0, -1))}
+
+
+def check_failed(conn, name: str, key_prompt: str) -> bool:
+    entries = outbox_entries(conn)
+    inflight = conn.keys("vision:inflight:*")
+    ok = not inflight and sorted(entries) == [f"{key_prompt}-0", f"{key_prompt}-1"] and all(e["error"] for e in entries.values())
+    print(f"{name}: {'OK' if ok else 'FAILED'} (outbox {sorted(entries)}, in flight {inflight})", flush=True)
+    return ok
+
+
+def killed_horse(server, worker, conn) -> bool:
+    submit(server, conn, "killed")
+    lazy = worker.LazyWorker([worker.Queue(worker.LEGACY_QUEUE, connection=conn)], connection=conn)
+
+    def kill_horse():
+        arrived.wait(30)
+        os.kill(lazy._horse_pid, signal.SIGKILL)
+
+    threading.Thread(target=kill_horse, daemon=True).start()
+    lazy.work(burst=True)
+    return check_failed(conn, "Killed work horse", "killed")
+
+
+# The model server never answers, so the job runs into its timeout, or into the memory limit of a worker
+# that does not fork. Either has to end the job instead of being retried as a model server failure.
+def timed_out(server, worker, conn, worker_class, name: str) -> bool:
+    job = Job.fetch(submit(server, conn, name)["job_id"], connection=conn)
+    job.timeout = 2
+    job.save()
+    worker_class([worker.Queue(worker.LEGACY_QUEUE, connection=conn)], connection=conn).work(burst=True)
+    return check_failed(conn, f"Timeout with {worker_class.__name__}", name)
+
+
+def memory_limit(server, worker, conn) -> bool:
+    submit(server, conn, "memory")
+    limit = worker.WORKER_MAX_RSS_MB
+    worker.WORKER_MAX_RSS_MB = 1
+    try:
+        worker.PrewarmedWorker([worker.Queue(worker.LEGACY_QUEUE, connection=conn)], connection=conn).work(burst=True)
+    finally:
+        worker.WORKER_MAX_RSS_MB = limit
+    return check_failed(conn, "Memory limit of PrewarmedWorker", "memory")
+
+
+def delivered_then_died(server, conn) -> bool:
+    job_id = submit(server, conn, "delivered")["job_id"]
+    job = Job.fetch(job_id, connection=conn)
+    server._deliver_result("delivered-0", job.args[5], {"done": True})
+    server.release_failed_job(job, conn)
+    entries = outbox_entries(conn)
+    ok = sorted(entries) == ["delivered-0", "delivered-1"] and not any(e["error"] for e in entries.values())
+    print(f"Died after delivering: {'OK' if ok else 'FAILED'} (outbox {entries})", flush=True)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Jobs that die without delivering release their task and its duplicates")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15", help="scratch database, flushed before every case")
+    args = parser.parse_args()
+
+    model_port = free_port()
+    serve_in_thread(hanging_model_server(), model_port)
+    run_dir = tempfile.mkdtemp(prefix="job-failure-test-")
+    write_env(run_dir, free_port(), False)
+    os.environ.update({"REDIS_URL": args.redis_url, "MODEL_SERVER_URLS": f"http://127.0.0.1:{model_port}/infer"})
+    os.environ.pop("MODEL_SERVER_URL", None)
+    sys.path[:0] = [run_dir, REPO_DIR]
+
+    import server
+    import worker
+
+    results = [
+        killed_horse(server, worker, server.redis_conn),
+        timed_out(server, worker, server.redis_conn, worker.LazyWorker, "timeout-fork"),
+        timed_out(server, worker, server.redis_conn, worker.PrewarmedWorker, "timeout-prewarmed"),
+        memory_limit(server, worker, server.redis_conn),
+        delivered_then_died(server, server.redis_conn),
+    ]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
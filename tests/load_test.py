@@ -0,0 +1,505 @@
+# End-to-end load test without a GPU: the real server.py app, Redis queue, worker.py and outbox.py
+# against a stand-in model server and a stand-in manager that receives the results.
+#
+#   python tests/load_test.py --rate 5 --duration 60 --workers 4 --slots 2 --latency-median 1.5
+#   python tests/load_test.py --rate 5 --duration 60 --workers 1 --autoscale 6 --slots 4
+#
+# The Redis database given by --redis-url is flushed before the run, point it at a scratch database.
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import uvicorn
+import requests
+
+from redis import Redis
+from rq.job import Job
+from datetime import timezone
+from collections import defaultdict
+from urllib.parse import parse_qs
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "load-test"
+TASK_PATTERN = re.compile(r"task (\S+)$")
+WORKERS_PATTERN = re.compile(r"^workers_running (\S+)$", re.MULTILINE)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = {}                 # task id -> {"start", "end", "status", "job_id"}
+        self.model_calls = defaultdict(list)  # task id -> [(start, end, outcome)]
+        self.replica_calls = defaultdict(lambda: defaultdict(int))  # replica -> outcome -> calls
+        self.delivered = {}                 # task id -> (received, has_error)
+        self.duplicate_deliveries = 0
+        self.queue_depths = []              # (time, depth)
+        self.worker_counts = []             # (time, running workers), with --autoscale
+
+    def deliver(self, results: list):
+        now = time.time()
+        with self.lock:
+            for result in results:
+                if result["task_id"] in self.delivered:
+                    self.duplicate_deliveries += 1
+                else:
+                    self.delivered[result["task_id"]] = (now, "error" in result)
+
+
+# ----------- Stand-in model server -----------
+def fake_model_server(args, recorder: Recorder, name: str, broken: bool = False) -> FastAPI:
+    app = FastAPI()
+    state = {"busy": 0, "queued": 0, "slots": None}
+
+    def record(task_id, start, outcome):
+        recorder.model_calls[task_id].append((start, time.time(), outcome))
+        recorder.replica_calls[name][outcome] += 1
+
+    def sample_latency() -> float:
+        return args.latency_median * math.exp(random.gauss(0, args.latency_sigma)) if args.latency_sigma else args.latency_median
+
+    def sample_result() -> dict:
+        value = "x" * args.value_bytes if args.value_bytes else True
+        return {f"field_{i}": value for i in range(args.result_keys)}
+
+    @app.get("/capacity")
+    async def capacity():
+        return {
+            "slots": args.slots,
+            "busy": state["busy"],
+            "queued": state["queued"],
+            "saturated": state["busy"] + state["queued"] >= args.slots,
+        }
+
+    @app.post("/infer")
+    async def infer(request: Request):
+        body = await request.json()
+        match = TASK_PATTERN.search(body["prompt"])
+        task_id = match.group(1) if match else None
+        start = time.time()
+
+        # Same contract as the scheduler of the real model server: bounded wait for a slot, 503 after that
+        if state["slots"] is None:
+            state["slots"] = asyncio.Semaphore(args.slots)
+        if broken:
+            record(task_id, start, "error")
+            return JSONResponse({"detail": "broken replica"}, status_code=500)
+        if state["queued"] >= args.model_queue_limit:
+            record(task_id, start, "full")
+            return JSONResponse({"detail": "queue full"}, status_code=503)
+
+        state["queued"] += 1
+        try:
+            await state["slots"].acquire()
+        finally:
+            state["queued"] -= 1
+
+        state["busy"] += 1
+        try:
+            await asyncio.sleep(sample_latency())
+        finally:
+            state["busy"] -= 1
+            state["slots"].release()
+
+        roll = random.random()
+        if roll < args.failure_rate:
+            record(task_id, start, "error")
+            return JSONResponse({"detail": "injected failure"}, status_code=500)
+        if roll < args.failure_rate + args.empty_rate:
+            record(task_id, start, "empty")
+            return {"result": None}
+
+        record(task_id, start, "ok")
+        return {"result": sample_result(), "timings": None}
+
+    return app
+
+
+# ----------- Stand-in manager -----------
+def fake_manager(recorder: Recorder) -> FastAPI:
+    app = FastAPI()
+
+    # The manager takes form data, parsed by hand so python-multipart is not needed
+    async def form(request: Request) -> dict:
+        return {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+
+    @app.post("/result")
+    async def result(request: Request):
+        recorder.deliver([json.loads((await form(request))["result_json"])])
+        return PlainTextResponse("ok")
+
+    @app.post("/results")
+    async def results(request: Request):
+        recorder.deliver(json.loads((await form(request))["results_json"]))
+        return PlainTextResponse("ok")
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app: FastAPI, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# ----------- Stack under test -----------
+# env.py is generated into the working directory of the processes, so results go to the stand-in manager
+def write_env(run_dir: str, manager_port: int, batch: bool):
+    with open(os.path.join(run_dir, "env.py"), "w") as f:
+        f.write(f"MANAGER_API = 'http://127.0.0.1:{manager_port}'\n")
+        f.write("SEND_PROMPT_RESULT_ROUTE = '/result'\n")
+        f.write(f"SEND_PROMPT_RESULTS_BATCH_ROUTE = {'/results' if batch else ''!r}\n")
+        f.write(f"PROMPT_TOKEN = '{TOKEN}'\n")
+        f.write(f"SERVER_TOKEN = '{TOKEN}'\n")
+
+
+def start_stack(args, run_dir: str, server_port: int, model_ports: list, supervisor_port: int) -> list:
+    env = dict(os.environ)
+    env.pop("MODEL_SERVER_URL", None)
+    env.update({
+        "PYTHONPATH": REPO_DIR,
+        "REDIS_URL": args.redis_url,
+        "MODEL_SERVER_URLS": ",".join(f"http://127.0.0.1:{port}/infer" for port in model_ports),
+        "OUTBOX_METRICS_PORT": str(free_port()),
+        # Every task ends at the manager, failures included, so none are left unaccounted for
+        "OUTBOX_DELIVER_ERRORS": "1",
+        "WORKER_FORK": "0" if args.no_fork else "1",
+    })
+
+    commands = [("server", [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning"])]
+    if args.autoscale:
+        # The supervisor starts with --workers and scales up to --autoscale, quicker than in production
+        env.update({
+            "WORKERS_MIN": str(args.workers),
+            "WORKERS_MAX": str(args.autoscale),
+            "SUPERVISOR_INTERVAL": "1",
+            "SUPERVISOR_IDLE_SECONDS": "5",
+            "SUPERVISOR_METRICS_PORT": str(supervisor_port),
+        })
+        commands += [("supervisor", [sys.executable, "-m", "supervisor"])]
+    else:
+        commands += [(f"worker-{i}", [sys.executable, "-m", "worker"]) for i in range(args.workers)]
+    commands += [("outbox", [sys.executable, "-m", "outbox"])]
+
+    processes = []
+    for name, command in commands:
+        log = open(os.path.join(run_dir, f"{name}.log"), "w")
+        processes.append((name, subprocess.Popen(command, cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)))
+    return processes
+
+
+def stop_stack(processes: list):
+    for _, process in processes:
+        process.terminate()
+    for name, process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            print(f"{name} did not stop, killing it", flush=True)
+            process.kill()
+
+
+def wait_for(url: str, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up in {timeout}s")
+
+
+# ----------- Load -----------
+def submit(session: requests.Session, url: str, args, recorder: Recorder, i: int):
+    task_id = f"lt-{i}"
+    task = {
+        "images": [f"https://load-test.invalid/{i}.jpg"],
+        "token": TOKEN,
+        "task_id": task_id,
+        "system_prompt": None,
+        "prompt": f"load test task {task_id}",
+        "priority": args.priority,
+    }
+    if args.tenants:
+        task["tenant"] = f"tenant-{i % args.tenants}"
+    if args.schema:
+        task["expected_json_schema"] = {f"field_{k}": "str" if args.value_bytes else "bool" for k in range(args.result_keys)}
+
+    start = time.time()
+    try:
+        res = session.post(url, json=task, timeout=30)
+        body = res.json() if res.status_code == 200 else {}
+        status = body.get("status", f"http {res.status_code}")
+    except requests.RequestException as e:
+        body, status = {}, f"error {type(e).__name__}"
+
+    with recorder.lock:
+        recorder.submitted[task_id] = {"start": start, "end": time.time(), "status": status, "job_id": body.get("job_id")}
+
+
+def drive(args, server_url: str, recorder: Recorder):
+    session = requests.Session()
+    url = server_url + "/inference/new_vision_task"
+    executor = ThreadPoolExecutor(max_workers=args.clients, thread_name_prefix="client")
+
+    start = time.time()
+    next_arrival = start
+    i = 0
+    while next_arrival < start + args.duration:
+        time.sleep(max(0, next_arrival - time.time()))
+        executor.submit(submit, session, url, args, recorder, i)
+        i += 1
+        next_arrival += random.expovariate(args.rate) if args.arrivals == "poisson" else 1 / args.rate
+
+    executor.shutdown(wait=True)
+    return i
+
+
+def sample_queue(server_url: str, supervisor_url: str, recorder: Recorder, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            depths = requests.get(server_url + "/inference/queues", timeout=2).json()
+            recorder.queue_depths.append((time.time(), sum(stats["depth"] for stats in depths.values())))
+            if supervisor_url:
+                match = WORKERS_PATTERN.search(requests.get(supervisor_url, timeout=2).text)
+                if match:
+                    recorder.worker_counts.append((time.time(), int(float(match.group(1)))))
+        except (requests.RequestException, ValueError):
+            pass
+        stop.wait(1)
+
+
+def wait_for_drain(recorder: Recorder, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with recorder.lock:
+            pending = [t for t, s in recorder.submitted.items() if s["status"] == "queued" and t not in recorder.delivered]
+        if not pending:
+            return 0
+        time.sleep(0.5)
+    return len(pending)
+
+
+# ----------- Report -----------
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    at = lambda q: values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+    return {
+        "count": len(values),
+        "p50": round(at(0.50), 3),
+        "p90": round(at(0.90), 3),
+        "p99": round(at(0.99), 3),
+        "max": round(values[-1], 3),
+        "avg": round(sum(values) / len(values), 3),
+    }
+
+
+def _epoch(dt):
+    if dt is None:
+        return None
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+
+# Least squares slope of the queue depth while tasks were arriving, > 0 means the stack falls behind
+def _growth(samples: list) -> float:
+    if len(samples) < 2:
+        return 0.0
+    t0 = samples[0][0]
+    xs = [t - t0 for t, _ in samples]
+    ys = [d for _, d in samples]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var if var else 0.0
+
+
+# Average per-job cost of the worker execution mode, forking and reaping the work horse or its remainder without fork
+def _overhead(redis_conn: Redis) -> dict:
+    totals = {key.decode(): float(value) for key, value in redis_conn.hgetall("vision:workers:overhead").items()}
+    modes = {key.split(":")[0] for key in totals}
+    return {mode: round(totals[f"{mode}:seconds"] / totals[f"{mode}:jobs"] * 1000, 2) for mode in modes if totals.get(f"{mode}:jobs")}
+
+
+def report(args, recorder: Recorder, redis_conn: Redis, load_start: float, load_end: float) -> dict:
+    submitted = recorder.submitted
+    job_ids = {t: s["job_id"] for t, s in submitted.items() if s["job_id"]}
+    jobs = {job.id: job for job in Job.fetch_many(list(job_ids.values()), connection=redis_conn) if job is not None}
+
+    hops = defaultdict(list)
+    for task_id, sub in submitted.items():
+        hops["submit"].append(sub["end"] - sub["start"])
+        calls = recorder.model_calls.get(task_id, [])
+        hops["model_call"].extend(end - start for start, end, _ in calls)
+
+        delivered = recorder.delivered.get(task_id)
+        if delivered:
+            hops["end_to_end"].append(delivered[0] - sub["start"])
+
+        job = jobs.get(job_ids.get(task_id))
+        if job is not None and job.enqueued_at and job.started_at:
+            hops["queue_wait"].append(_epoch(job.started_at) - _epoch(job.enqueued_at))
+            if calls:
+                # Model calls including the worker's retries and the sleeps between them
+                hops["worker"].append(calls[-1][1] - _epoch(job.started_at))
+        if delivered and calls:
+            hops["delivery"].append(delivered[0] - calls[-1][1])
+
+    outcomes = defaultdict(int)
+    for calls in recorder.model_calls.values():
+        for _, _, outcome in calls:
+            outcomes[outcome] += 1
+
+    statuses = defaultdict(int)
+    for sub in submitted.values():
+        statuses[sub["status"]] += 1
+
+    delivered_times = [received for received, _ in recorder.delivered.values()]
+    window = [(t, d) for t, d in recorder.queue_depths if load_start <= t <= load_end]
+    elapsed = (max(delivered_times) - load_start) if delivered_times else 0
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "submitted": len(submitted),
+        "submit_status": dict(statuses),
+        "delivered": len(recorder.delivered),
+        "delivered_with_error": sum(1 for _, error in recorder.delivered.values() if error),
+        "duplicate_deliveries": recorder.duplicate_deliveries,
+        "dead_lettered": redis_conn.llen("vision:outbox:dead"),
+        "offered_rate": round(len(submitted) / (load_end - load_start), 3) if load_end > load_start else None,
+        "throughput": round(len(recorder.delivered) / elapsed, 3) if elapsed else None,
+        "model_calls": dict(outcomes),
+        "replica_calls": {name: dict(calls) for name, calls in sorted(recorder.replica_calls.items())},
+        "queue": {
+            "max_depth": max((d for _, d in recorder.queue_depths), default=0),
+            "depth_at_end_of_load": window[-1][1] if window else None,
+            "growth_per_second": round(_growth(window), 3),
+        },
+        "workers": {
+            "max": max((w for _, w in recorder.worker_counts), default=args.workers),
+            "at_end": recorder.worker_counts[-1][1] if recorder.worker_counts else args.workers,
+            "overhead_ms_per_job": _overhead(redis_conn),
+        },
+        "latency_seconds": {hop: percentiles(hops[hop]) for hop in ("submit", "queue_wait", "model_call", "worker", "delivery", "end_to_end")},
+    }
+
+
+def print_report(result: dict):
+    print("\n---------- Load test ----------")
+    print(f"Submitted {result['submitted']} tasks at {result['offered_rate']}/s {result['submit_status']}")
+    print(f"Delivered {result['delivered']} ({result['delivered_with_error']} with error, {result['duplicate_deliveries']} duplicates, {result['dead_lettered']} dead-lettered)")
+    print(f"Throughput {result['throughput']}/s, model calls {result['model_calls']}")
+    for name, calls in result["replica_calls"].items():
+        print(f"  {name}: {calls}")
+    queue = result["queue"]
+    print(f"Queue: max depth {queue['max_depth']}, {queue['depth_at_end_of_load']} at end of load, growing {queue['growth_per_second']}/s")
+    print(f"Workers: up to {result['workers']['max']}, {result['workers']['at_end']} at the end, overhead per job {result['workers']['overhead_ms_per_job']} ms")
+    print(f"\n{'hop':<12}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for hop, stats in result["latency_seconds"].items():
+        if stats["count"]:
+            print(f"{hop:<12}{stats['count']:>7}{stats['p50']:>9}{stats['p90']:>9}{stats['p99']:>9}{stats['max']:>9}")
+        else:
+            print(f"{hop:<12}{0:>7}")
+    print("-------------------------------")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of server, queue, worker and outbox against a stand-in model server")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15", help="scratch database, flushed before the run")
+    parser.add_argument("--rate", type=float, default=2, help="task arrivals per second")
+    parser.add_argument("--arrivals", choices=["poisson", "uniform"], default="poisson")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="seconds to wait for outstanding results after the load")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent submitting connections")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--no-fork", action="store_true", help="run jobs in pre-warmed worker processes instead of forked work horses")
+    parser.add_argument("--autoscale", type=int, default=0, help="run the worker supervisor, scaling from --workers up to this many")
+    parser.add_argument("--priority", default="default")
+    parser.add_argument("--tenants", type=int, default=0, help="spread tasks over this many tenants")
+    parser.add_argument("--batch", action="store_true", help="deliver through the manager batch route")
+    parser.add_argument("--replicas", type=int, default=1, help="fake model servers behind the replica pool")
+    parser.add_argument("--broken-replicas", type=int, default=0, help="replicas that answer every inference with HTTP 500")
+    parser.add_argument("--slots", type=int, default=1, help="concurrent inferences of each fake model server")
+    parser.add_argument("--model-queue-limit", type=int, default=16)
+    parser.add_argument("--latency-median", type=float, default=1.0, help="seconds per inference")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="lognormal spread, 0 for a fixed latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of inferences answered with HTTP 500")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="share of inferences without a result")
+    parser.add_argument("--result-keys", type=int, default=5)
+    parser.add_argument("--value-bytes", type=int, default=0, help="string values of this size instead of booleans")
+    parser.add_argument("--schema", action="store_true", help="send an expected_json_schema matching the fake results")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    redis_conn = Redis.from_url(args.redis_url)
+    redis_conn.flushdb()
+
+    recorder = Recorder()
+    model_ports = [free_port() for _ in range(args.replicas)]
+    manager_port, server_port = free_port(), free_port()
+    model_servers = [
+        serve_in_thread(fake_model_server(args, recorder, f"replica-{i}", broken=i < args.broken_replicas), port)
+        for i, port in enumerate(model_ports)
+    ]
+    manager = serve_in_thread(fake_manager(recorder), manager_port)
+
+    run_dir = tempfile.mkdtemp(prefix="load-test-")
+    write_env(run_dir, manager_port, args.batch)
+    print(f"Logs in {run_dir}", flush=True)
+
+    supervisor_port = free_port()
+    processes = start_stack(args, run_dir, server_port, model_ports, supervisor_port)
+    supervisor_url = f"http://127.0.0.1:{supervisor_port}/metrics" if args.autoscale else None
+    server_url = f"http://127.0.0.1:{server_port}"
+    stop_sampling = threading.Event()
+    try:
+        wait_for(server_url + "/ping", timeout=60)
+        threading.Thread(target=sample_queue, args=(server_url, supervisor_url, recorder, stop_sampling), daemon=True).start()
+
+        load_start = time.time()
+        sent = drive(args, server_url, recorder)
+        load_end = time.time()
+        print(f"Sent {sent} tasks in {load_end - load_start:.1f}s, waiting for results", flush=True)
+
+        missing = wait_for_drain(recorder, args.drain_timeout)
+        if missing:
+            print(f"{missing} tasks still without a result after {args.drain_timeout}s", flush=True)
+        result = report(args, recorder, redis_conn, load_start, load_end)
+    finally:
+        stop_sampling.set()
+        stop_stack(processes)
+        for model_server in model_servers:
+            model_server.should_exit = True
+        manager.should_exit = True
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import os
+import ctypes
+import pickle
+import threading
+import llama_cpp
+import llama_cpp.llava_cpp as llava_cpp
+
+from llama_cpp import Llama
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class LRUCache:
+    def __init__(self, capacity_mb: float):
+        self.capacity_bytes = int(capacity_mb * 1024 * 1024)
+        self.size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (value, size in bytes), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int) -> bool:
+        if size > self.capacity_bytes:
+            return False
+
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= previous[1]
+
+            self._entries[key] = (value, size)
+            self.size_bytes += size
+
+            while self.size_bytes > self.capacity_bytes:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self.size_bytes -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+
+        for old_key, old_value in evicted:
+            self._on_evict(old_key, old_value)
+
+        return True
+
+    # Drops an entry that turned out to be unusable
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            self.size_bytes -= entry[1]
+
+        self._on_evict(key, entry[0])
+
+    def _on_evict(self, key, value):
+        pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_mb": round(self.size_bytes / (1024 * 1024), 2),
+            "capacity_mb": round(self.capacity_bytes / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Llama.save_state also copies the full logits matrix (n_batch x n_vocab floats, hundreds of MB
+# for MiniCPM), which is not needed to continue from a prefix since generate() re-evaluates the
+# last prompt token anyway. This keeps only the context state and the evaluated token ids.
+class LlamaSnapshot:
+    def __init__(self, input_ids, n_tokens: int, state: bytes):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.state = state
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.state) + self.input_ids.nbytes
+
+    @classmethod
+    def capture(cls, llm: Llama) -> "LlamaSnapshot":
+        ctx = llm._ctx.ctx
+        buffer = (ctypes.c_uint8 * llama_cpp.llama_state_get_size(ctx))()
+        n_bytes = llama_cpp.llama_state_get_data(ctx, buffer, len(buffer))
+        return cls(llm.input_ids[:llm.n_tokens].copy(), llm.n_tokens, ctypes.string_at(buffer, n_bytes))
+
+    # Raises RuntimeError for a state the context cannot take, e.g. one written by another llama.cpp build
+    def restore(self, llm: Llama):
+        if self.n_tokens > llm.n_ctx():
+            raise RuntimeError(f"Llama state of {self.n_tokens} tokens does not fit n_ctx {llm.n_ctx()}")
+        buffer = (ctypes.c_uint8 * len(self.state)).from_buffer_copy(self.state)
+        if llama_cpp.llama_state_set_data(llm._ctx.ctx, buffer, len(self.state)) != len(self.state):
+            raise RuntimeError("Failed to restore llama state")
+
+        llm.input_ids[:self.n_tokens] = self.input_ids
+        llm.n_tokens = self.n_tokens
+
+
+# Snapshots of the evaluated system prompt + fixed template prefix, optionally mirrored
+# to disk so a restarted model server starts warm
+class PrefixStateCache(LRUCache):
+    def __init__(self, capacity_mb: float, cache_dir: Optional[str] = None):
+        super().__init__(capacity_mb)
+        self.cache_dir = cache_dir
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.__load_from_disk()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.state")
+
+    def __load_from_disk(self):
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".state")]
+        # Oldest first so the most recently written snapshots end up most recently used
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with open(path, "rb") as f:
+                    snapshot = pickle.load(f)
+            except Exception as e:
+                print(f"Dropping unreadable prefix state {path}: {e}", flush=True)
+                os.remove(path)
+                continue
+
+            key = os.path.basename(path)[:-len(".state")]
+            super().put(key, snapshot, snapshot.size_bytes)
+
+        print(f"Loaded {len(self)} prefix states from {self.cache_dir}", flush=True)
+
+    def put(self, key: str, snapshot: LlamaSnapshot) -> bool:
+        if not super().put(key, snapshot, snapshot.size_bytes):
+            return False
+
+        if self.cache_dir:
+            path = self.__path(key)
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"Failed to persist prefix state {key}: {e}", flush=True)
+
+        return True
+
+    def _on_evict(self, key, value):
+        if not self.cache_dir:
+            return
+
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError:
+            pass
+
+
+# Projector output copied into memory we own, so entries can be shared and evicted
+# without tracking llava_image_embed_free calls
+class ImageEmbedding:
+    def __init__(self, data, n_image_pos: int):
+        self.data = data
+        self.n_image_pos = n_image_pos
+
+    @property
+    def size_bytes(self) -> int:
+        return ctypes.sizeof(self.data)
+
+    @classmethod
+    def copy_from(cls, embed, n_embd: int) -> "ImageEmbedding":
+        n_image_pos = embed.contents.n_image_pos
+        data = (ctypes.c_float * (n_image_pos * n_embd))()
+        ctypes.memmove(data, embed.contents.embed, ctypes.sizeof(data))
+        return cls(data, n_image_pos)
+
+    def as_llava_embed(self):
+        return ctypes.pointer(llava_cpp.llava_image_embed(
+            embed=ctypes.cast(self.data, ctypes.POINTER(ctypes.c_float)),
+            n_image_pos=self.n_image_pos,
+        ))
+
+
+class ImageEmbedCache(LRUCache):
+    def put(self, key: str, embedding: ImageEmbedding) -> bool:
+        return super().put(key, embedding, embedding.size_bytes)
@@ -1,18 +1,65 @@
-import io
 import os
 import sys
-import base64
+import ctypes
+import queue
 import hashlib
-import requests
-
-from PIL import Image
-from time import sleep
-from llama_cpp import Llama
-from datetime import datetime
-from typing import List, Union, Dict
-from jsonz.validator import is_valid_json
-from jsonz.extractor import extract_json_from_str
+import llama_cpp
+
+from time import perf_counter
+from llama_cpp import Llama, LlamaGrammar
+from typing import List, Union, Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from vision.fetch import image_fetcher
+from vision.images import RequestImage, load_image, pixel_budget, warmup_image
+from vision.cache import LRUCache, LlamaSnapshot, PrefixStateCache, ImageEmbedding, ImageEmbedCache
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+from jsonz.validator import CompiledSchema, compile_schema
+from jsonz.grammar import JSON_OBJECT_GBNF, schema_to_gbnf
+from jsonz.extractor import JsonStreamExtractor
 from llama_cpp.llama_chat_format import register_chat_format, Llava15ChatHandler
+from prometheus_client import Counter, Histogram
+
+# Stages of a request on the model server, exported on its /metrics
+_SECONDS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+image_decode_duration_seconds = Histogram("image_decode_duration_seconds", "Decode, orientation and downsizing of one image", buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2))
+image_embed_cache_lookups = Counter("image_embed_cache_lookups", "Projector embedding cache lookups", ["result"])
+projector_encode_duration_seconds = Histogram("projector_encode_duration_seconds", "Projector encode of one image, cache misses only", buckets=_SECONDS)
+prompt_prefill_duration_seconds = Histogram("prompt_prefill_duration_seconds", "Evaluation of system prompt, text and images before sampling", buckets=_SECONDS)
+prompt_tokens_per_request = Histogram("prompt_tokens_per_request", "Prompt length in tokens, image positions included", buckets=(256, 512, 1024, 2048, 4096, 8192, 16384))
+completion_tokens_per_sample = Histogram("completion_tokens_per_sample", "Tokens generated per sample", buckets=(16, 32, 64, 128, 256, 512, 1024, 2048))
+decode_tokens_per_second = Histogram("decode_tokens_per_second", "Generation speed per sample", buckets=(1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200))
+sample_failures = Counter("sample_failures", "Samples that produced no acceptable JSON object", ["reason"])
+consensus_samples = Histogram("consensus_samples", "Samples decoded per request", buckets=(1, 2, 3, 4, 5, 6, 7, 8, 9))
+reconciliation_disagreements = Counter("reconciliation_disagreements", "Result fields the samples of a request did not agree on")
+inference_requests = Counter("inference_requests", "Prompt requests by outcome", ["outcome"])
+inference_request_duration_seconds = Histogram("inference_request_duration_seconds", "Prefill and sampling of a request", buckets=_SECONDS)
+
+
+# Warm-up runs the request path once before the model server is ready, its time is exported by the
+# model server as a startup phase and stays out of the request metrics
+class _Unrecorded:
+    def labels(self, *_):
+        return self
+
+    def observe(self, _):
+        pass
+
+    def inc(self, _=1):
+        pass
+
+
+_UNRECORDED = _Unrecorded()
+_warming_up = False
+
+
+def _recorded(metric):
+    return _UNRECORDED if _warming_up else metric
+
+# A clip context runs one encode at a time and the llava bindings have no batched encode. More than one
+# context encodes the images of a request side by side, each extra one holds another copy of the projector.
+# Opt-in because that copy does not fit next to MODEL_SLOTS models on every GPU, with one context the
+# images still overlap the text prefill but are encoded one after the other.
+PROJECTOR_CONTEXTS = max(1, int(os.getenv("PROJECTOR_CONTEXTS", "1")))
 
 # ----------- Chat handler ----------- 
 # No official support for this yet 
@@ -20,9 +67,24 @@ from llama_cpp.llama_chat_format import register_chat_format, Llava15ChatHandler
 class MiniCPMo26ChatHandler(Llava15ChatHandler):
     DEFAULT_SYSTEM_MESSAGE = None
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The projector contexts are shared by every model slot, an encode takes one from the pool
+        self._clip_pool = queue.Queue()
+        self._clip_pool.put(self.clip_ctx)
+        for _ in range(PROJECTOR_CONTEXTS - 1):
+            clip_ctx = self._llava_cpp.clip_model_load(self.clip_model_path.encode(), 0)
+            if clip_ctx is None:
+                raise ValueError(f"Failed to load clip model: {self.clip_model_path}")
+            self._exit_stack.callback(self._llava_cpp.clip_free, clip_ctx)
+            self._clip_pool.put(clip_ctx)
+        self._encoder = ThreadPoolExecutor(max_workers=PROJECTOR_CONTEXTS, thread_name_prefix="projector")
+
     CHAT_FORMAT = (
         "{% for message in messages %}"
-        "{% if message['role'] == 'user' %}"
+        "{% if message['role'] == 'system' %}"
+        "<|system|>\n{{ message['content'] }}\n"
+        "{% elif message['role'] == 'user' %}"
         "<|user|>\n"
         "{% if message['content'] is iterable %}"
         "{% for part in message['content'] %}"
@@ -42,6 +104,128 @@ class MiniCPMo26ChatHandler(Llava15ChatHandler):
         "<|assistant|>\n"
     )
 
+    # Everything up to here only depends on the system prompt and can be reused across requests
+    PREFIX_END = "<|user|>\n"
+
+    def __eval_text(self, llama: Llama, text: str):
+        tokens = llama.tokenize(text.encode("utf8"), add_bos=False, special=True)
+        if llama.n_tokens + len(tokens) > llama.n_ctx():
+            raise ValueError(f"Prompt exceeds n_ctx: {llama.n_tokens + len(tokens)} > {llama.n_ctx()}")
+        llama.eval(tokens)
+
+    def __encode_image(self, image: RequestImage, n_threads: int, n_embd: int, embed_cache: Optional[ImageEmbedCache]) -> ImageEmbedding:
+        buffer = (ctypes.c_uint8 * len(image.data)).from_buffer_copy(image.data)
+        clip_ctx = self._clip_pool.get()
+        try:
+            start = perf_counter()
+            embed = self._llava_cpp.llava_image_embed_make_with_bytes(clip_ctx, n_threads, buffer, len(image.data))
+            image.encode_seconds = round(perf_counter() - start, 4)
+            _recorded(projector_encode_duration_seconds).observe(image.encode_seconds)
+        finally:
+            self._clip_pool.put(clip_ctx)
+        if not embed:
+            raise ValueError("Projector failed to encode image")
+
+        try:
+            embedding = ImageEmbedding.copy_from(embed, n_embd)
+        finally:
+            self._llava_cpp.llava_image_embed_free(embed)
+
+        if embed_cache is not None:
+            embed_cache.put(image.key, embedding)
+        return embedding
+
+    # Starts encoding every image of the request at once, the text is evaluated meanwhile.
+    # The same picture sent twice is encoded once.
+    def __embed_images(self, llama: Llama, images: Dict[str, RequestImage], embed_cache: Optional[ImageEmbedCache]) -> Dict[str, Future]:
+        by_key, first = {}, {}
+        for image in images.values():
+            if image.key in by_key:
+                continue
+            first[image.key] = image
+            embedding = embed_cache.get(image.key) if embed_cache is not None else None
+            _recorded(image_embed_cache_lookups).labels("miss" if embedding is None else "hit").inc()
+            by_key[image.key] = Future()
+            if embedding is not None:
+                by_key[image.key].set_result(embedding)
+
+        misses = [key for key, future in by_key.items() if not future.done()]
+        if misses:
+            # The slot's share of the CPU is split between its prefill and the encodes running side by side,
+            # other slots encode on their own share
+            slot_threads = llama.context_params.n_threads_batch
+            n_threads = max(1, slot_threads // (1 + min(len(misses), PROJECTOR_CONTEXTS)))
+            for key in misses:
+                by_key[key] = self._encoder.submit(self.__encode_image, first[key], n_threads, llama.n_embd(), embed_cache)
+
+        return {placeholder: by_key[image.key] for placeholder, image in images.items()}
+
+    # A snapshot only fits the llama.cpp build, model file and context shape it was taken with, all part
+    # of the key so states persisted in PREFIX_CACHE_DIR by another setup are never picked up
+    @staticmethod
+    def __prefix_key(llama: Llama, prefix: str) -> str:
+        params = llama.context_params
+        setup = [llama_cpp.__version__, llama.model_path, os.path.getsize(llama.model_path), llama.n_ctx(), llama.n_batch, params.type_k, params.type_v]
+        return hashlib.sha256("\0".join(map(str, setup + [prefix])).encode()).hexdigest()
+
+    # Mirrors the prompt evaluation half of Llava15ChatHandler.__call__ so the evaluated
+    # state can be snapshotted and reused by several completions. Image urls in the messages
+    # are placeholders for the in-memory images of the request.
+    def prefill(
+        self,
+        llama: Llama,
+        messages: List[dict],
+        images: Dict[str, RequestImage],
+        prefix_cache: Optional[PrefixStateCache] = None,
+        embed_cache: Optional[ImageEmbedCache] = None,
+    ) -> List[int]:
+        embeddings = self.__embed_images(llama, images, embed_cache)
+
+        image_urls = self.get_image_urls(messages)
+        template = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True).from_string(self.CHAT_FORMAT)
+        text = template.render(messages=messages, add_generation_prompt=True)
+
+        prefix_end = text.find(self.PREFIX_END)
+        prefix_len = prefix_end + len(self.PREFIX_END) if prefix_end != -1 else 0
+        prefix, text = text[:prefix_len], text[prefix_len:]
+
+        llama.reset()
+        llama._ctx.kv_cache_clear()
+
+        prefix_key = self.__prefix_key(llama, prefix)
+        snapshot = prefix_cache.get(prefix_key) if prefix_cache is not None else None
+        if snapshot is not None:
+            try:
+                snapshot.restore(llama)
+            except RuntimeError as e:
+                print(f"Dropping prefix state {prefix_key}: {e}", flush=True)
+                prefix_cache.discard(prefix_key)
+                llama.reset()
+                llama._ctx.kv_cache_clear()
+                snapshot = None
+        if snapshot is None:
+            self.__eval_text(llama, prefix)
+            if prefix_cache is not None:
+                prefix_cache.put(prefix_key, LlamaSnapshot.capture(llama))
+
+        for type_, value in self.split_text_on_image_urls(text, image_urls):
+            if type_ == "text":
+                self.__eval_text(llama, value)
+                continue
+
+            embedding = embeddings[value].result()
+            images[value].tokens = embedding.n_image_pos
+            if llama.n_tokens + embedding.n_image_pos > llama.n_ctx():
+                raise ValueError(f"Prompt exceeds n_ctx: {llama.n_tokens + embedding.n_image_pos} > {llama.n_ctx()}")
+
+            n_past = ctypes.c_int(llama.n_tokens)
+            self._llava_cpp.llava_eval_image_embed(llama.ctx, embedding.as_llava_embed(), llama.n_batch, ctypes.pointer(n_past))
+            # Image positions have no token ids, same as the upstream handler
+            llama.input_ids[llama.n_tokens:n_past.value] = -1
+            llama.n_tokens = n_past.value
+
+        return llama.input_ids[:llama.n_tokens].tolist()
+
 class suppress_stdout(object):
     def __enter__(self):
         self.outnull_file = open(os.devnull, 'w')
@@ -77,14 +261,61 @@ class suppress_stdout(object):
         self.errnull_file.close()
 
 
-class ImageInference:
-    def __init__(self):
-        self._saved_image_path = None 
+# create_chat_completion defaults, create_completion alone would stop after 16 tokens
+SAMPLING_PARAMS = {
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "top_k": 40,
+    "min_p": 0.05,
+    "max_tokens": None,
+}
+
+# Sample n of every request is drawn with seed SAMPLE_SEED + n. Without a seed llama-cpp-python derives
+# the next one from the previous, so a result would depend on what ran on the slot before.
+SAMPLE_SEED = int(os.getenv("SAMPLE_SEED", "0"))
+
+# Constrain sampling to the expected schema, every sample then parses and validates on the first attempt
+SCHEMA_GRAMMAR = os.getenv("SCHEMA_GRAMMAR", "1") == "1"
+
+
+# LlamaGrammar.from_string only keeps the text and llama.cpp parses it once sampling starts, a broken
+# grammar has to be caught here or every sample of the request fails
+def parse_grammar(gbnf: str) -> LlamaGrammar:
+    sampler = llama_cpp.llama_sampler_init_grammar(None, gbnf.encode("utf-8"), b"root")
+    if not sampler:
+        raise ValueError("llama.cpp could not parse the grammar")
+    llama_cpp.llama_sampler_free(sampler)
+    return LlamaGrammar.from_string(gbnf, verbose=False)
 
+
+class ImageInference:
+    # Slots of one model server share the caches and the projector. Each slot loads its own Llama: the
+    # mmapped weights share the page cache, but the GPU offloaded layers and the KV cache are per slot.
+    def __init__(
+        self,
+        n_threads: Optional[int] = None,
+        prefix_cache: Optional[PrefixStateCache] = None,
+        embed_cache: Optional[ImageEmbedCache] = None,
+        chat_handler: Optional[MiniCPMo26ChatHandler] = None,
+        grammar_cache: Optional[LRUCache] = None,
+    ):
         self.elapsed_minutes = 0
+        self.last_timings = None
+        self.load_timings = {}
+        self.n_threads = n_threads or os.cpu_count()
+
+        if prefix_cache is None:
+            prefix_cache = PrefixStateCache(
+                capacity_mb=float(os.getenv("PREFIX_CACHE_MB", "1024")),
+                cache_dir=os.getenv("PREFIX_CACHE_DIR") or None,
+            )
+        if embed_cache is None:
+            embed_cache = ImageEmbedCache(capacity_mb=float(os.getenv("IMAGE_EMBED_CACHE_MB", "512")))
 
-        self.image_dir = 'images'
-        os.makedirs(self.image_dir, exist_ok=True)
+        self.prefix_cache = prefix_cache
+        self.embed_cache = embed_cache
+        # Grammars are keyed by schema hash and shared by every slot
+        self.grammar_cache = grammar_cache if grammar_cache is not None else LRUCache(capacity_mb=8)
 
         print("Loading MiniCPM-o-2_6 model with multimodal support…", flush=True)
 
@@ -98,13 +329,18 @@ class ImageInference:
             raise FileNotFoundError(f"Missing projector at {projector_path}")
 
         with suppress_stdout():
-            chat_handler = MiniCPMo26ChatHandler(clip_model_path=projector_path)
+            start = perf_counter()
+            self._chat_handler = chat_handler or MiniCPMo26ChatHandler(clip_model_path=projector_path)
+            self.load_timings["projector_seconds"] = round(perf_counter() - start, 3) if chat_handler is None else 0
 
+            start = perf_counter()
             self.llm = Llama(
                 model_path=model_path,
-                chat_handler=chat_handler,
+                chat_handler=self._chat_handler,
                 chat_format="minicpm-o-2_6",
-                n_threads=os.cpu_count(),
+                n_threads=self.n_threads,
+                # Defaults to every core, prefill of parallel slots would fight over them
+                n_threads_batch=self.n_threads,
                 n_ctx=16384,
                 n_gpu_layers=8,
                 main_gpu=0,
@@ -116,123 +352,216 @@ class ImageInference:
                 typical_p=1.0,
                 mirostat_mode=0,
             )
+            self.load_timings["weights_seconds"] = round(perf_counter() - start, 3)
 
-        print("Model loaded ✔️", flush=True)
+        print(f"Model loaded ✔️ (projector {self.load_timings['projector_seconds']}s, weights {self.load_timings['weights_seconds']}s)", flush=True)
         print("GPU used:", self.llm.model_params.n_gpu_layers > 0, flush=True)
 
-    def __cleanup_images(self):
-        if self._saved_image_path is None or not os.path.isfile(self._saved_image_path): 
-            return 
-        
-        try: 
-            os.remove(self._saved_image_path)
-            print(f"Deleted temporary image: {self._saved_image_path}", flush=True)
-        except Exception as e:
-            print(f"Failed to delete image {self._saved_image_path}: {e}", flush=True) 
+    def new_slot(self) -> "ImageInference":
+        return ImageInference(
+            n_threads=self.n_threads,
+            prefix_cache=self.prefix_cache,
+            embed_cache=self.embed_cache,
+            chat_handler=self._chat_handler,
+            grammar_cache=self.grammar_cache,
+        )
+
+    # Runs a generated image through prefill and sampling, so the first real request does not pay for
+    # paging in the weights, cold GPU kernels and the system prompt state
+    def warm_up(self, prompt: str, system_prompt: Optional[str] = None) -> Optional[dict]:
+        image = load_image(warmup_image(), pixel_budget())
+        messages = [{"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": "image://0"}}]}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
 
-    def __process_image_content(self, images, content):
-        image_found = False
-        for img in images:
-            img_data = None
+        global _warming_up
+        _warming_up = True
+        try:
+            self.__get_inference_result(messages, {"image://0": image}, None, repeat_target=1)
+        finally:
+            _warming_up = False
+        return self.last_timings
 
-            if os.path.isfile(img):
-                img_data = f"file://{os.path.abspath(img)}"
-            elif img.startswith(("http://", "https://")):
-                res = requests.get(img, timeout=10)
-                if res is None or res.status_code != 200: 
-                    continue
+    def __process_image_content(self, images, content, max_pixels: int):
+        urls = [img for img in images if not os.path.isfile(img) and img.startswith(("http://", "https://"))]
+        downloaded = dict(zip(urls, image_fetcher.fetch_all(urls)))
 
-                name_hash = hashlib.md5(img.encode()).hexdigest()
-                save_path = os.path.join(self.image_dir, f"{name_hash}.png")
-                with Image.open(io.BytesIO(res.content)).convert("RGB") as im:
-                    im.save(save_path, format="PNG")
+        request_images = {}
+        for img in images:
+            data = None
 
-                self._saved_image_path = os.path.abspath(save_path)
-                img_data = f"file://{self._saved_image_path}"
+            if os.path.isfile(img):
+                with open(img, "rb") as f:
+                    data = f.read()
+            elif img in downloaded:
+                data = downloaded[img]
 
-            if img_data is None:
+            if data is None:
                 print("Skipping unsupported image:", img, flush=True)
                 continue
 
+            try:
+                image = load_image(data, max_pixels)
+            except Exception as e:
+                print(f"Skipping undecodable image {img}: {e}", flush=True)
+                continue
+            _recorded(image_decode_duration_seconds).observe(image.decode_seconds)
+
+            # Only rendered into the template to mark where the image goes
+            placeholder = f"image://{len(request_images)}"
+            request_images[placeholder] = image
             content.append({
                 "type": "image_url",
-                "image_url": {"url": img_data}
+                "image_url": {"url": placeholder}
             })
-            image_found = True
 
-        return content if image_found else None
+        return (content, request_images) if request_images else (None, None)
 
-    def prompt(self, prompt: str, system_prompt: Union[str, None], images: List[str], expected_json_schema: dict) -> Union[str, None]:
+    def prompt(self, prompt: str, system_prompt: Union[str, None], images: List[str], expected_json_schema: dict, max_slices: Optional[int] = None) -> Union[str, None]:
         print("Running prompt", flush=True)
         if not prompt or not isinstance(prompt, str) or not images:
             print("Invalid prompt or images", flush=True)
+            _recorded(inference_requests).labels("invalid").inc()
             return None
 
+        # Raises SchemaError before any image or model work for schemas that no output could satisfy
+        schema = compile_schema(expected_json_schema) if expected_json_schema else None
+
         content = [{"type": "text", "text": prompt.strip()}]
-        content = self.__process_image_content(images=images, content=content)
+        # Large shots are downsized before the projector, every slice costs encode time and prompt tokens
+        content, request_images = self.__process_image_content(images=images, content=content, max_pixels=pixel_budget(max_slices))
         if not content:
             print("No valid images found")
+            _recorded(inference_requests).labels("no_images").inc()
             return None
 
         messages = [{"role": "user", "content": content}]
         if system_prompt:
             messages.insert(0, {"role": "system", "content": system_prompt})
 
-        result = self.__get_inference_result(messages, expected_json_schema)
-
-        self.__cleanup_images()
-
-        return result 
+        return self.__get_inference_result(messages, request_images, schema)
 
-    def __get_inference_result(self, messages, expected_json_schema, repeat_target=3):
+    def __get_inference_result(self, messages, images, schema: Optional[CompiledSchema], repeat_target=3):
         repeat_count = 0
         repeated_results = []
-        repeat_count_target = repeat_target * 3
+        grammar = self.__get_grammar(schema) if SCHEMA_GRAMMAR else None
+        # A constrained sample is valid by construction, retries are only needed without a grammar
+        repeat_count_target = repeat_target if grammar is not None else repeat_target * 3
+
+        request_start = perf_counter()
+        # System prompt, user text and images are evaluated once, every sample only decodes
+        try:
+            prompt_tokens = self._chat_handler.prefill(self.llm, messages, images, self.prefix_cache, self.embed_cache)
+            prefill_state = LlamaSnapshot.capture(self.llm)
+        except Exception as e:
+            print("LLM prefill error:", e, flush=True)
+            _recorded(inference_requests).labels("prefill_error").inc()
+            return None
+
+        prefill_seconds = perf_counter() - request_start
+        _recorded(prompt_prefill_duration_seconds).observe(prefill_seconds)
+        _recorded(prompt_tokens_per_request).observe(len(prompt_tokens))
+        image_stats = [image.stats() for image in images.values()]
+        self.last_timings = {
+            "prompt_tokens": len(prompt_tokens),
+            "prefill_seconds": round(prefill_seconds, 3),
+            "grammar": grammar is not None,
+            "images": image_stats,
+            "samples": [],
+        }
+        print(f"Prefill: {len(prompt_tokens)} tokens in {prefill_seconds:.2f}s", flush=True)
+        for stats in image_stats:
+            print(f"Image {stats['source_size'][0]}x{stats['source_size'][1]} -> {stats['size'][0]}x{stats['size'][1]}, ~{stats['source_tokens']} -> {stats['tokens']} tokens", flush=True)
 
         while repeat_count < repeat_count_target:
             try:
-                start = datetime.now()
-                res = self.llm.create_chat_completion(
-                    messages=messages,
-                    # response_format={"type": "json_object"},
-                )
-                self.elapsed_minutes = (datetime.now() - start).total_seconds() / 60
-                result = res["choices"][0]["message"]["content"].strip()
-                print("Result:", result)
-
-                extracted_json = extract_json_from_str(result)
+                prefill_state.restore(self.llm)
+
+                extractor = JsonStreamExtractor(accept=lambda obj: self.__matches_schema(obj, schema))
+                completion_tokens = 0
+                stopped_early = False
+
+                start = perf_counter()
+                stream = self.llm.create_completion(prompt=prompt_tokens, stream=True, grammar=grammar, seed=SAMPLE_SEED + repeat_count, **SAMPLING_PARAMS)
+                try:
+                    for chunk in stream:
+                        completion_tokens += 1
+                        # Stop decoding as soon as an acceptable object closes, whatever follows is discarded anyway
+                        if extractor.feed(chunk["choices"][0]["text"]) is not None:
+                            stopped_early = True
+                            break
+                finally:
+                    stream.close()
+                decode_seconds = perf_counter() - start
+                _recorded(completion_tokens_per_sample).observe(completion_tokens)
+                if decode_seconds > 0:
+                    _recorded(decode_tokens_per_second).observe(completion_tokens / decode_seconds)
+
+                self.last_timings["samples"].append({"decode_seconds": round(decode_seconds, 3), "completion_tokens": completion_tokens, "stopped_early": stopped_early})
+                print(f"Sample {repeat_count + 1}: prefill {prefill_seconds:.2f}s (shared), decode {decode_seconds:.2f}s for {completion_tokens} tokens", flush=True)
+                print("Result:", extractor.text.strip())
+
+                extracted_json = extractor.result
                 print("Extracted: ", extracted_json)
-                print("Type: ", type(extracted_json))
-                if not isinstance(extracted_json, dict):
-                    repeat_count += 1
-                    print(f"⚠️ Failed to extract JSON — retrying ({repeat_count})")
-                    sleep(5)
-                    continue
-
-                if len(extracted_json) > 0 and expected_json_schema and not is_valid_json(expected_json_schema, extracted_json):
+                if extracted_json is None:
                     repeat_count += 1
-                    print(f"⚠️ JSON validation failed — retrying ({repeat_count})")
-                    sleep(5)
+                    if extractor.rejected:
+                        _recorded(sample_failures).labels("schema").inc()
+                        print(f"⚠️ JSON validation failed — retrying ({repeat_count})")
+                    else:
+                        _recorded(sample_failures).labels("no_json").inc()
+                        print(f"⚠️ Failed to extract JSON — retrying ({repeat_count})")
                     continue
 
                 repeated_results.append(extracted_json)
                 repeat_count += 1
-                sleep(2)
 
                 if len(repeated_results) >= repeat_target:
                     break
 
             except Exception as e:
                 print("LLM inference error:", e, flush=True)
+                _recorded(sample_failures).labels("error").inc()
                 repeat_count += 1
-                sleep(2)
                 continue
 
+        self.elapsed_minutes = (perf_counter() - request_start) / 60
+        _recorded(inference_request_duration_seconds).observe(perf_counter() - request_start)
+        _recorded(consensus_samples).observe(repeat_count)
+
         if not repeated_results:
+            _recorded(inference_requests).labels("no_result").inc()
             return None
 
+        _recorded(inference_requests).labels("ok").inc()
+
         return self.__reconcile_result(repeated_results)
 
+    def __get_grammar(self, schema: Optional[CompiledSchema]) -> Optional[LlamaGrammar]:
+        key = schema.hash if schema is not None else "object"
+        grammar = self.grammar_cache.get(key)
+        if grammar is not None:
+            return grammar
+
+        try:
+            gbnf = schema_to_gbnf(schema.schema) if schema is not None else JSON_OBJECT_GBNF
+            grammar = parse_grammar(gbnf)
+        except Exception as e:
+            print("Could not build grammar, sampling unconstrained:", e, flush=True)
+            return None
+
+        self.grammar_cache.put(key, grammar, len(gbnf))
+        return grammar
+
+    def __matches_schema(self, extracted_json: dict, schema: Optional[CompiledSchema]) -> bool:
+        if len(extracted_json) == 0 or schema is None:
+            return True
+
+        violations = schema.validate(extracted_json)
+        for violation in violations:
+            print(f"Schema violation at {violation.path}: {violation.reason}", flush=True)
+        return len(violations) == 0
+
     def __reconcile_result(self, repeated_results: List[dict]):
         result_value_counter = {}
 
@@ -247,6 +576,7 @@ class ImageInference:
             key: max(value_count.items(), key=lambda x: x[1])[0]
             for key, value_count in result_value_counter.items()
         }
+        _recorded(reconciliation_disagreements).inc(sum(1 for value_count in result_value_counter.values() if len(value_count) > 1))
 
         print("Final result:")
         print(final_result)
@@ -0,0 +1,127 @@
+import os
+import threading
+import requests
+
+from time import monotonic
+from typing import List, Optional
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter, Histogram
+from concurrent.futures import ThreadPoolExecutor, wait
+
+image_fetch_duration_seconds = Histogram("image_fetch_duration_seconds", "Download time of one image, failed downloads included")
+image_fetch_failures = Counter("image_fetch_failures", "Images that could not be downloaded", ["reason"])
+image_fetch_bytes = Counter("image_fetch_bytes", "Bytes of downloaded images")
+
+
+class _ByteBudget:
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def consume(self, n: int) -> bool:
+        with self._lock:
+            self.remaining -= n
+            return self.remaining >= 0
+
+
+# Downloads all images of a request in parallel over one keep-alive pool shared by every request
+class ImageFetcher:
+    def __init__(self, max_workers: int = 8, per_host_limit: int = 4, max_total_mb: float = 64, deadline_seconds: float = 20, connect_timeout: float = 3):
+        self.per_host_limit = per_host_limit
+        self.max_total_bytes = int(max_total_mb * 1024 * 1024)
+        self.deadline_seconds = deadline_seconds
+        self.connect_timeout = connect_timeout
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max_workers, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-fetch")
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def __host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+
+    def __fetch(self, url: str, deadline: float, budget: _ByteBudget) -> Optional[bytes]:
+        with image_fetch_duration_seconds.time():
+            data, failure = self.__download(url, deadline, budget)
+        if failure:
+            image_fetch_failures.labels(failure).inc()
+        else:
+            image_fetch_bytes.inc(len(data))
+        return data
+
+    # (data, None) or (None, failure reason)
+    def __download(self, url: str, deadline: float, budget: _ByteBudget):
+        slot = self.__host_slot(url)
+        if not slot.acquire(timeout=max(0, deadline - monotonic())):
+            print("Image fetch timed out waiting for host slot:", url, flush=True)
+            return None, "host_slot"
+
+        try:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None, "deadline"
+
+            with self._session.get(url, stream=True, timeout=(min(self.connect_timeout, remaining), remaining)) as res:
+                if res.status_code != 200:
+                    print(f"Image fetch returned {res.status_code}: {url}", flush=True)
+                    return None, "status"
+
+                chunks = []
+                for chunk in res.iter_content(chunk_size=64 * 1024):
+                    if not budget.consume(len(chunk)):
+                        print("Image fetch exceeded request byte cap:", url, flush=True)
+                        return None, "byte_cap"
+                    if monotonic() > deadline:
+                        print("Image fetch exceeded request deadline:", url, flush=True)
+                        return None, "deadline"
+                    chunks.append(chunk)
+
+                return b"".join(chunks), None
+
+        except requests.RequestException as e:
+            print(f"Error fetching image from {url}: {e}", flush=True)
+            return None, "error"
+        finally:
+            slot.release()
+
+    # Results are in the order of urls, None for every image that could not be fetched in time
+    def fetch_all(self, urls: List[str]) -> List[Optional[bytes]]:
+        if not urls:
+            return []
+
+        deadline = monotonic() + self.deadline_seconds
+        budget = _ByteBudget(self.max_total_bytes)
+        futures = [self._executor.submit(self.__fetch, url, deadline, budget) for url in urls]
+        wait(futures, timeout=self.deadline_seconds)
+
+        results = []
+        for future in futures:
+            if not future.done():
+                future.cancel()
+                image_fetch_failures.labels("deadline").inc()
+                results.append(None)
+            elif future.exception() is not None:
+                print("Image fetch failed:", future.exception(), flush=True)
+                image_fetch_failures.labels("error").inc()
+                results.append(None)
+            else:
+                results.append(future.result())
+
+        return results
+
+
+image_fetcher = ImageFetcher(
+    max_workers=int(os.getenv("IMAGE_FETCH_WORKERS", "8")),
+    per_host_limit=int(os.getenv("IMAGE_FETCH_PER_HOST", "4")),
+    max_total_mb=float(os.getenv("IMAGE_FETCH_MAX_MB", "64")),
+    deadline_seconds=float(os.getenv("IMAGE_FETCH_DEADLINE", "20")),
+)
@@ -0,0 +1,155 @@
+import io
+import os
+import math
+import hashlib
+
+from PIL import Image, ImageDraw, ImageOps
+from time import perf_counter
+from typing import Optional
+
+# Formats stb_image inside the llava projector decodes itself, anything else is transcoded
+PROJECTOR_FORMATS = {"JPEG", "PNG", "BMP", "GIF"}
+
+# MiniCPM-o 2.6 projector: an overview plus up to 9 slices of 448 px, 64 prompt tokens each
+SLICE_SIZE = int(os.getenv("IMAGE_SLICE_SIZE", "448"))
+SLICE_TOKENS = int(os.getenv("IMAGE_SLICE_TOKENS", "64"))
+PROJECTOR_MAX_SLICES = 9
+
+MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(PROJECTOR_MAX_SLICES * SLICE_SIZE * SLICE_SIZE)))
+MAX_SLICES = int(os.getenv("IMAGE_MAX_SLICES", str(PROJECTOR_MAX_SLICES)))
+
+_EXIF_ORIENTATION = 0x0112
+
+
+# Port of llava_uhd::get_slice_instructions in clip.cpp, the number of slices next to the overview
+def slice_count(width: int, height: int) -> int:
+    multiple = min(math.ceil(width * height / (SLICE_SIZE * SLICE_SIZE)), PROJECTOR_MAX_SLICES)
+    if multiple <= 1:
+        return 0
+
+    log_ratio = math.log(width / height)
+    best, best_error = 1, math.inf
+    for n in (multiple - 1, multiple, multiple + 1):
+        if n == 1 or n > PROJECTOR_MAX_SLICES:
+            continue
+        for m in range(1, n + 1):
+            if n % m == 0:
+                error = abs(log_ratio - math.log(m / (n // m)))
+                if error < best_error:
+                    best, best_error = n, error
+    return best
+
+
+def image_tokens(width: int, height: int) -> int:
+    return SLICE_TOKENS * (1 + slice_count(width, height))
+
+
+# Largest pixel area the projector may see, a caller can only lower the configured slice cap
+def pixel_budget(max_slices: Optional[int] = None) -> int:
+    max_slices = MAX_SLICES if max_slices is None else min(max_slices, MAX_SLICES)
+    if max_slices >= PROJECTOR_MAX_SLICES:
+        return MAX_PIXELS
+    # Up to n - 1 slice areas lets the grid search in clip.cpp pick n slices at most, 0 and 1 mean the overview only
+    return min(MAX_PIXELS, max(1, max_slices - 1) * SLICE_SIZE * SLICE_SIZE)
+
+
+def fit_to_budget(width: int, height: int, max_pixels: int):
+    if width * height <= max_pixels:
+        return width, height
+    scale = math.sqrt(max_pixels / (width * height))
+    return max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+
+
+# Keyed by decoded pixels rather than URL or file bytes, the same product photo is
+# served under different URLs and encodings
+def pixel_key(image: Image.Image) -> str:
+    digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+# An image owned by a single request, kept in memory from download to projector
+class RequestImage:
+    def __init__(self, data: bytes, key: str, width: int, height: int, source_width: Optional[int] = None, source_height: Optional[int] = None):
+        self.data = data
+        self.key = key
+        self.width = width
+        self.height = height
+        self.source_width = source_width or width
+        self.source_height = source_height or height
+        self.decode_seconds = None
+        # Set by the chat handler once the projector has encoded the image, no encode time on a cache hit
+        self.tokens = None
+        self.encode_seconds = None
+
+    def stats(self) -> dict:
+        return {
+            "source_size": [self.source_width, self.source_height],
+            "size": [self.width, self.height],
+            "source_pixels": self.source_width * self.source_height,
+            "pixels": self.width * self.height,
+            "source_tokens": image_tokens(self.source_width, self.source_height),
+            "tokens": self.tokens,
+            "decode_seconds": self.decode_seconds,
+            "encode_seconds": self.encode_seconds,
+        }
+
+
+# Transparent product shots go on white, converting RGBA straight to RGB turns the background black
+def _to_rgb(image: Image.Image) -> Image.Image:
+    if image.mode == "RGB":
+        return image
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        rgb = Image.new("RGB", rgba.size, (255, 255, 255))
+        rgb.paste(rgba, mask=rgba.getchannel("A"))
+        return rgb
+    return image.convert("RGB")
+
+
+def load_image(data: bytes, max_pixels: int = MAX_PIXELS) -> RequestImage:
+    start = perf_counter()
+    with Image.open(io.BytesIO(data)) as im:
+        source_format = im.format
+        source_width, source_height = im.size
+        has_alpha = im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info)
+
+        target = fit_to_budget(source_width, source_height, max_pixels)
+        if target != im.size:
+            # JPEG decodes straight to the smallest 1/2, 1/4 or 1/8 scale that still covers the target
+            im.draft("RGB", target)
+
+        # stb_image ignores EXIF, rotated phone photos have to be transposed here
+        transposed = im.getexif().get(_EXIF_ORIENTATION, 1) != 1
+        image = ImageOps.exif_transpose(im) if transposed else im
+
+        rgb = _to_rgb(image)
+        rgb.load()
+        size = fit_to_budget(rgb.width, rgb.height, max_pixels)
+        if size != rgb.size:
+            rgb = rgb.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        key = pixel_key(rgb)
+
+        resized = rgb.size != (source_width, source_height) and rgb.size != (source_height, source_width)
+        if source_format not in PROJECTOR_FORMATS or resized or transposed or has_alpha:
+            # Uncompressed BMP is close to a memcpy, unlike the PNG encode this replaces
+            buffer = io.BytesIO()
+            rgb.save(buffer, format="BMP")
+            data = buffer.getvalue()
+
+        image = RequestImage(data, key, rgb.width, rgb.height, source_width, source_height)
+        image.decode_seconds = round(perf_counter() - start, 4)
+        return image
+
+
+# Stand-in product photo for the model warm-up, a JPEG large enough to be sliced like a real shot
+def warmup_image() -> bytes:
+    image = Image.new("RGB", (1024, 768), (245, 245, 245))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((212, 184, 812, 584), fill=(40, 90, 160), outline=(20, 20, 20), width=6)
+    draw.ellipse((412, 284, 612, 484), fill=(230, 180, 40))
+    draw.text((240, 620), "WARM-UP 1024x768", fill=(20, 20, 20))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
@@ -4,6 +4,7 @@ import base64
 import requests
 from datetime import datetime
 from typing import List, Union 
+from vision.fetch import image_fetcher
 
 
 class ImageInference: 
@@ -27,34 +28,29 @@ class ImageInference:
         self.elapsed_minutes = 0
         
     def __encode_image(self, img: str):
-        if img.startswith('http'):
-            return base64.b64encode(img).decode()
-        else: 
-            with open(img, "rb") as f:
-                return base64.b64encode(f.read()).decode()
+        with open(img, "rb") as f:
+            return base64.b64encode(f.read()).decode()
     
     def __process_images(self, images): 
+        if not all(isinstance(img, str) for img in images):
+            return None
+
+        urls = [img for img in images if img.startswith('http')]
+        downloaded = dict(zip(urls, image_fetcher.fetch_all(urls)))
+
         encoded_images = []
         for img in images: 
-            if not isinstance(img, str):
-                continue
-
             # To support local images for testing purposes 
             if not img.startswith('http'):
                 encoded_images.append(self.__encode_image(img))
                 continue
 
             # TODO -> Add later failure recovery
-            try: 
-                res = requests.get(img)
-                print("Res status: ")
-                if res is None or res.status_code != 200: 
-                    continue
-                
-                encoded_images.append(self.__encode_image(res.content))
-
-            except Exception as e: 
+            if downloaded[img] is None:
                 print("Error fetching image from: ", img)
+                continue
+
+            encoded_images.append(base64.b64encode(downloaded[img]).decode())
         
         # If any image failed to be encoded return None, as original prompt requested these 
         # we need to ensure it either fails completely or does it's job properly.
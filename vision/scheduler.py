@@ -0,0 +1,69 @@
+import asyncio
+
+from collections import deque
+from time import perf_counter
+from typing import Any, Callable, List
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+# Hands queued requests to a fixed set of model slots (one llama context each), first come first served.
+# Counters are only touched on the event loop thread, the models run on a dedicated thread per slot.
+class InferenceScheduler:
+    def __init__(self, models: List[Any], max_queue: int):
+        self.slots = len(models)
+        self.max_queue = max_queue
+        self.models = models
+
+        self.busy = 0
+        self.queued = 0
+        self.completed = 0
+        self.latencies = deque(maxlen=50)
+
+        self._free = asyncio.Queue()
+        for model in models:
+            self._free.put_nowait(model)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="model-slot")
+
+    async def run(self, fn: Callable[[Any], Any]) -> Any:
+        if self.queued >= self.max_queue:
+            raise SchedulerFull(f"{self.queued} requests already waiting for {self.slots} slots")
+
+        self.queued += 1
+        try:
+            model = await self._free.get()
+        finally:
+            self.queued -= 1
+
+        self.busy += 1
+        start = perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, model)
+        # The slot is released when the model is done, even if the request awaiting it was cancelled
+        future.add_done_callback(lambda _: self.__release(model, start))
+        return await asyncio.shield(future)
+
+    def __release(self, model: Any, start: float):
+        self.busy -= 1
+        self.completed += 1
+        self.latencies.append(perf_counter() - start)
+        self._free.put_nowait(model)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "slots": self.slots,
+            "busy": self.busy,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "saturated": self.busy + self.queued >= self.slots,
+            "recent_latency_seconds": {
+                "avg": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p95": round(latencies[int(len(latencies) * 0.95)], 3) if latencies else None,
+                "samples": len(latencies),
+            },
+        }
@@ -1,28 +1,201 @@
 import os
-from time import sleep
-from rq import Worker, Queue
+import math
+import signal
+import resource
+import threading
+import async_queue
+from time import sleep, monotonic, perf_counter
+from multiprocessing.sharedctypes import RawValue
+from rq import Worker, SimpleWorker, Queue
 from redis import Redis
 from redis.exceptions import ConnectionError
+from server import get_model_server_capacity, release_failed_job
+from priority import FairQueueOrder, LEGACY_QUEUE, parse_queue_name
 
-# To give some breathing room to the internal DNS cache and model-server 
+MIN_BACKOFF = float(os.getenv('WORKER_MIN_BACKOFF', '0.5'))
+MAX_BACKOFF = float(os.getenv('WORKER_MAX_BACKOFF', '10'))
+# Longest blocking pop, queues of new tenants are only watched after the next refresh
+QUEUE_REFRESH_SECONDS = int(os.getenv('WORKER_QUEUE_REFRESH', '5'))
+# 0 runs every job in the worker process itself instead of a freshly forked work horse
+WORKER_FORK = os.getenv('WORKER_FORK', '1') == '1'
+# Without fork a job that grows the worker past this fails, and the worker exits after it to start clean
+WORKER_MAX_RSS_MB = int(os.getenv('WORKER_MAX_RSS_MB', '1024'))
+# Jobs between two log lines with the average per-job overhead
+OVERHEAD_REPORT_JOBS = int(os.getenv('WORKER_OVERHEAD_REPORT_JOBS', '100'))
+
+# Fields <mode>:seconds and <mode>:jobs, summed over every worker
+OVERHEAD_KEY = "vision:workers:overhead"
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # Peak instead of current size, kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Not an Exception, so the retry loop of the job cannot swallow it and the job fails
+class MemoryLimitExceeded(BaseException):
+    pass
+
+# Only pulls the next job once the model server has a free slot, instead of napping after every job.
+# Listens on every priority/tenant queue and picks the next one by weight instead of draining in order.
 class LazyWorker(Worker):
+    mode = "fork"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__fair_order = FairQueueOrder()
+        # Shared memory survives the fork, the work horse reports how long the job itself took
+        self.__perform_seconds = RawValue('d', 0.0)
+        self.__overhead = []
+
+    # Everything around the job that the execution mode adds: fork, waiting on the horse, its exit
     def execute_job(self, job, queue):
+        self.__perform_seconds.value = 0.0
+        start = perf_counter()
         super().execute_job(job, queue)
-        if job.is_finished:
-            print("[WORKER] Job completed, taking a nap...", flush=True)
-            sleep(5)
+        if not self.__perform_seconds.value:
+            # The horse was killed before it could report, there is nothing to compare
+            return
+        overhead = max(0.0, perf_counter() - start - self.__perform_seconds.value)
+
+        self.__overhead.append(overhead)
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.hincrbyfloat(OVERHEAD_KEY, f"{self.mode}:seconds", overhead)
+        pipe.hincrby(OVERHEAD_KEY, f"{self.mode}:jobs", 1)
+        pipe.execute()
+        if len(self.__overhead) >= OVERHEAD_REPORT_JOBS:
+            print(f"[WORKER] {self.mode} mode overhead {sum(self.__overhead) / len(self.__overhead) * 1000:.1f}ms per job over {len(self.__overhead)} jobs", flush=True)
+            self.__overhead = []
+
+    # RQ runs no failure callback for a work horse killed from outside, e.g. by the OOM killer
+    def handle_work_horse_killed(self, job, retpid, ret_val, rusage):
+        super().handle_work_horse_killed(job, retpid, ret_val, rusage)
+        release_failed_job(job, self.connection)
+
+    def perform_job(self, job, queue):
+        start = perf_counter()
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            self.__perform_seconds.value = perf_counter() - start
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        idle_since = monotonic()
+        while True:
+            self.__wait_for_model_capacity()
+            self.__order_queues()
+
+            # Burst mode pops without blocking, nothing to refresh
+            if timeout is None:
+                return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+
+            wait = QUEUE_REFRESH_SECONDS
+            if max_idle_time is not None:
+                wait = min(wait, math.ceil(max_idle_time - (monotonic() - idle_since)))
+                if wait <= 0:
+                    return None
+
+            result = super().dequeue_job_and_maintain_ttl(timeout, max(1, wait))
+            if result is not None or self._stop_requested:
+                return result
+
+    # Called by rq with the queue the job came from
+    def reorder_queues(self, reference_queue):
+        self.__fair_order.served(reference_queue.name)
+
+    def __order_queues(self):
+        depths = async_queue.parse_queue_depths(self.connection.eval(*async_queue.queue_depths_args()))
+        depths = {name: depth for name, depth in depths.items() if parse_queue_name(name) is not None}
+        depths.setdefault(LEGACY_QUEUE, 0)
+
+        known = {queue.name: queue for queue in self.queues}
+        self.queues = [
+            known.get(name) or Queue(name, connection=self.connection, job_class=self.job_class, serializer=self.serializer)
+            for name in self.__fair_order.order(depths)
+        ]
+        self._ordered_queues = self.queues[:]
+
+    def __wait_for_model_capacity(self):
+        backoff = MIN_BACKOFF
+        while not self._stop_requested:
+            capacity = get_model_server_capacity()
+            if capacity is not None and not capacity.get("saturated"):
+                return
+
+            if capacity is None:
+                print(f"[WORKER] Model server unreachable, backing off {backoff:.1f}s", flush=True)
+            elif capacity.get("status", "ready") != "ready":
+                print(f"[WORKER] Model server {capacity['status']}, backing off {backoff:.1f}s", flush=True)
+            else:
+                print(f"[WORKER] Model server saturated ({capacity['busy']}/{capacity['slots']} busy, {capacity['queued']} queued), backing off {backoff:.1f}s", flush=True)
+
+            self.heartbeat()
+            sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+# Runs jobs in this long-lived process: HTTP connections, resolved addresses, compiled schemas and
+# imported modules carry over from one job to the next. Job timeouts still apply through SIGALRM,
+# and a watchdog fails a job that grows the process past WORKER_MAX_RSS_MB.
+class PrewarmedWorker(LazyWorker, SimpleWorker):
+    mode = "prewarmed"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__job_running = False
+        self.__over_limit = False
+
+    def work(self, *args, **kwargs):
+        # Connects to every model server replica up front, the first job finds the connections open
+        get_model_server_capacity()
+        signal.signal(signal.SIGUSR2, self.__memory_limit_exceeded)
+        threading.Thread(target=self.__watch_memory, name="memory-watchdog", daemon=True).start()
+        return super().work(*args, **kwargs)
+
+    def perform_job(self, job, queue):
+        self.__job_running = True
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            self.__job_running = False
+
+    def execute_job(self, job, queue):
+        super().execute_job(job, queue)
+        if self.__over_limit or rss_mb() > WORKER_MAX_RSS_MB:
+            # Whatever the job left behind goes with the process, the supervisor starts a fresh one
+            print(f"[WORKER] Using {rss_mb():.0f}MB, more than {WORKER_MAX_RSS_MB}MB, exiting", flush=True)
+            self._stop_requested = True
+
+    def __watch_memory(self):
+        main_thread = threading.main_thread().ident
+        while True:
+            sleep(1)
+            if self.__job_running and not self.__over_limit and rss_mb() > WORKER_MAX_RSS_MB:
+                self.__over_limit = True
+                signal.pthread_kill(main_thread, signal.SIGUSR2)
+
+    def __memory_limit_exceeded(self, signum, frame):
+        if self.__job_running:
+            raise MemoryLimitExceeded(f"Worker grew past {WORKER_MAX_RSS_MB}MB")
 
 
-listen = ['default']
+listen = [LEGACY_QUEUE]
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 
 if __name__ == '__main__':
     while True: 
         try: 
             conn = Redis.from_url(redis_url, socket_timeout=None, retry_on_timeout=True)
-            queue = Queue('default', connection=conn)
-            worker = LazyWorker([queue], connection=conn)
+            queue = Queue(LEGACY_QUEUE, connection=conn)
+            worker_class = LazyWorker if WORKER_FORK else PrewarmedWorker
+            worker = worker_class([queue], connection=conn)
+            # Returns after a warm shutdown, e.g. when the supervisor retires this worker
             worker.work()
+            break
         except ConnectionError as e: 
             print(f"[WORKER] Redis unavailable, retrying in 2s... ({e})", flush=True)
             sleep(2)